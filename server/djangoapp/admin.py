@@ -1,4 +1,5 @@
 from django.contrib import admin
+from .cars import invalidate_car_choices
 from .models import CarModel,CarMake
 
 
@@ -8,13 +9,31 @@ from .models import CarModel,CarMake
 class CarModelInline(admin.StackedInline):
     model = CarModel
     extra = 5
+# Drops the cached car choices of the add_review page whenever cars or makes change
+class InvalidateCarChoicesMixin:
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        invalidate_car_choices()
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        invalidate_car_choices()
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        invalidate_car_choices()
+
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        invalidate_car_choices()
+
 # CarModelAdmin class
-class CarModelAdmin(admin.ModelAdmin):
+class CarModelAdmin(InvalidateCarChoicesMixin, admin.ModelAdmin):
     list_display = ['car_make', 'name', 'dealer_id', 'car_model', 'year']
     list_filter = ['car_model', 'car_make', 'dealer_id', 'year',]
     search_fields = ['car_make', 'name']
 # CarMakeAdmin class with CarModelInline
-class CarMakeAdmin(admin.ModelAdmin):
+class CarMakeAdmin(InvalidateCarChoicesMixin, admin.ModelAdmin):
     list_display = ['name', 'description']
     search_fields = ['name']
     inlines = [CarModelInline]
@@ -1,5 +1,20 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class DjangoappConfig(AppConfig):
     name = 'djangoapp'
+
+    def ready(self):
+        from .instrumentation import enabled
+
+        # Times the ORM queries of every database connection, only when instrumentation is on
+        if enabled():
+            connection_created.connect(install_query_wrapper)
+
+
+def install_query_wrapper(sender, connection, **kwargs):
+    from .instrumentation import query_wrapper
+
+    if query_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(query_wrapper)
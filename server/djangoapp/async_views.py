@@ -0,0 +1,103 @@
+import logging
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.shortcuts import redirect, render
+
+from .breaker import CircuitOpenError, UpstreamUnavailable
+from .cars import get_car_choices
+from .instrumentation import span
+from .restapis import (async_fetch_concurrently, async_get_dealer_by_id, async_get_dealer_reviews_page,
+                       async_post_request, get_dealer_index, store_review)
+from .views import NOT_POSTED, dealers_page_response, review_from_form, unavailable_response
+
+logger = logging.getLogger(__name__)
+
+
+# Async versions of the dealer pages, used when the app runs under an ASGI server
+# (settings.ASYNC_VIEWS, see urls.py). Upstream calls go through the async HTTP client, so a
+# worker serves other requests while it waits on the API gateway; the database and templates
+# are still synchronous and run through sync_to_async.
+
+# Update the `get_dealerships` view to render the index page with a list of dealerships
+async def get_dealerships(request):
+    if request.method == "GET":
+        context = {}
+        # The dealer index is cached in memory, only its first load waits on the upstream
+        try:
+            dealer_index = await sync_to_async(get_dealer_index)(settings.DEALERSHIPS_URL)
+        except UpstreamUnavailable:
+            return await sync_to_async(unavailable_response)(request, as_json=request.GET.get("format") == "json")
+        if request.GET.get("format") == "json":
+            return await sync_to_async(dealers_page_response)(request, dealer_index)
+        context["states"] = sorted(dealer_index.by_state)
+        context["total"] = len(dealer_index.dealers)
+        with span("render"):
+            return await sync_to_async(render)(request, 'djangoapp/index.html', context)
+
+
+# Create a `get_dealer_details` view to render the reviews of a dealer
+async def get_dealer_details(request, dealer_id):
+    if request.method == "GET":
+        results, errors = await async_fetch_concurrently(
+            reviews=async_get_dealer_reviews_page(settings.REVIEWS_URL, dealer_id, limit=settings.REVIEWS_PAGE_SIZE,
+                                                  bookmark=request.GET.get("bookmark")),
+            dealer=async_get_dealer_by_id(settings.DEALER_URL, dealer_id=dealer_id),
+        )
+        unavailable = isinstance(errors.get("reviews"), UpstreamUnavailable)
+        if "reviews" in errors and not unavailable:
+            raise errors["reviews"]
+        reviews, next_bookmark = results.get("reviews", ([], None))
+        context = {
+            "reviews": reviews,
+            "dealer_id": dealer_id,
+            "next_bookmark": next_bookmark,
+            "dealer": results.get("dealer"),
+            "unavailable": unavailable,
+        }
+        with span("render"):
+            return await sync_to_async(render)(request, 'djangoapp/dealer_details.html', context,
+                                               status=503 if unavailable else 200)
+
+
+# Create a `add_review` view to submit a review
+async def add_review(request, dealer_id):
+    # User must be logged in before posting a review (loading the user reads the session)
+    if await sync_to_async(lambda: request.user.is_authenticated)():
+        # GET request renders the page with the form for filling out a review
+        if request.method == "GET":
+            # The dealer's cars are loaded from the database (or cache) while the dealer is fetched
+            results, errors = await async_fetch_concurrently(
+                cars=sync_to_async(get_car_choices)(dealer_id),
+                dealer=async_get_dealer_by_id(settings.DEALER_URL, dealer_id=dealer_id),
+            )
+            for error in errors.values():
+                if isinstance(error, UpstreamUnavailable):
+                    return await sync_to_async(unavailable_response)(request)
+                raise error
+            context = {
+                "cars": results["cars"],
+                "dealer": results["dealer"],
+            }
+            with span("render"):
+                return await sync_to_async(render)(request, 'djangoapp/add_review.html', context)
+
+        # POST request posts the content in the review submission form with the post_review Cloud Function
+        if request.method == "POST":
+            review = await sync_to_async(review_from_form)(request, dealer_id)
+            try:
+                result = await async_post_request(settings.REVIEWS_URL, {"review": review}, dealerId=dealer_id)
+            except (CircuitOpenError, httpx.HTTPError):
+                return await sync_to_async(unavailable_response)(request, message=NOT_POSTED)
+            if int(result.status_code) != 200:
+                logger.warning("Posting a review of dealer %s failed with status %s", dealer_id, result.status_code)
+                return await sync_to_async(unavailable_response)(request, message=NOT_POSTED)
+            logger.debug("Review posted successfully.")
+            await sync_to_async(store_review)(review)
+            return redirect("djangoapp:dealer_details", dealer_id=dealer_id)
+
+    else:
+        # If user isn't logged in, redirect to login page
+        logger.debug("User must be authenticated before posting a review. Please log in.")
+        return redirect("/djangoapp/login")
@@ -0,0 +1,169 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .decoders import decode
+
+
+# Default configuration of the upstream circuit breakers, overridden by settings.UPSTREAM_BREAKER
+DEFAULTS = {
+    "FAILURE_THRESHOLD": 5,     # consecutive failures that open the circuit of an endpoint
+    "RESET_TIMEOUT": 30,        # seconds an open circuit fails fast before a trial call is let through
+    "HALF_OPEN_CALLS": 1,       # trial calls in flight at once while half-open
+    "FALLBACK_CACHE": "shared",  # CACHES alias of the last known good responses
+    "FALLBACK_RESAVE": 300,     # seconds after which an unchanged response is saved again
+}
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(Exception):
+    # Raised instead of calling an endpoint whose circuit is open
+    pass
+
+
+class UpstreamUnavailable(Exception):
+    # Raised instead of returning a GET response when the endpoint fails, or its circuit is open,
+    # and no last known good response of the request was saved yet
+    pass
+
+
+class CircuitBreaker:
+    # The health of one upstream endpoint.
+    # closed: calls go through, consecutive failures are counted and open the circuit at the threshold
+    # open: calls fail fast without touching the network, for reset_timeout seconds
+    # half-open: a few trial calls go through, a success closes the circuit and a failure opens it again
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, half_open_calls=1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.failures = 0
+        self.opened_at = None
+        self.trials = 0
+        self.trial_started = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return CLOSED
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return OPEN
+        return HALF_OPEN
+
+    # Returns whether a call may go to the endpoint now, every allowed call must be followed
+    # by record_success or record_failure
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN:
+                now = time.monotonic()
+                # Trial calls that never reported back (e.g. a cancelled task) are given up on
+                if self.trials and now - self.trial_started > self.reset_timeout:
+                    self.trials = 0
+                if self.trials < self.half_open_calls:
+                    self.trials += 1
+                    self.trial_started = now
+                    return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trials = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                # A failed trial call (or too many failures) opens the circuit for another reset_timeout
+                self.opened_at = time.monotonic()
+                self.trials = 0
+
+
+def _config():
+    return dict(DEFAULTS, **getattr(settings, "UPSTREAM_BREAKER", {}))
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+# Returns the circuit breaker of the endpoint of a url (its host and path, not its query)
+def get_breaker(url):
+    parts = urlsplit(url)
+    name = "{}://{}{}".format(parts.scheme, parts.netloc, parts.path)
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                config = _config()
+                breaker = _breakers[name] = CircuitBreaker(name, config["FAILURE_THRESHOLD"],
+                                                           config["RESET_TIMEOUT"], config["HALF_OPEN_CALLS"])
+    return breaker
+
+
+# The state of every endpoint's circuit, by endpoint
+def breaker_states():
+    return {name: breaker.state for name, breaker in list(_breakers.items())}
+
+
+def reset_breakers():
+    with _breakers_lock:
+        _breakers.clear()
+    with _saved_lock:
+        _saved.clear()
+
+
+# The last known good response of every GET (url and parameters), served while the endpoint
+# fails or its circuit is open. Kept in a CACHES alias without expiry: share it (e.g. a
+# database or file cache) to keep it across workers and restarts.
+# The raw response bytes are saved, not the decoded data, and only when they changed: most GETs
+# return what was saved last time, so they only hash the bytes instead of pickling the response
+# and writing it to the cache. An unchanged response is still saved every FALLBACK_RESAVE
+# seconds, in case the cache dropped it.
+def _fallback_key(url, params):
+    request = json.dumps([url, params], sort_keys=True, default=str)
+    return "upstream-fallback:" + hashlib.sha256(request.encode()).hexdigest()
+
+
+# Digest and time of the last response this process saved, by fallback key
+_saved = OrderedDict()
+_saved_lock = threading.Lock()
+MAX_SAVED = 4096
+
+
+def save_fallback(url, params, content):
+    config = _config()
+    key = _fallback_key(url, params)
+    digest = hashlib.blake2b(content, digest_size=16).digest()
+    now = time.monotonic()
+    with _saved_lock:
+        saved = _saved.get(key)
+        if saved is not None and saved[0] == digest and now - saved[1] < config["FALLBACK_RESAVE"]:
+            return
+    caches[config["FALLBACK_CACHE"]].set(key, content, timeout=None)
+    with _saved_lock:
+        _saved[key] = (digest, now)
+        _saved.move_to_end(key)
+        while len(_saved) > MAX_SAVED:
+            _saved.popitem(last=False)
+
+
+# Returns the decoded last known good response of a GET, or None
+def get_fallback(url, params):
+    content = caches[_config()["FALLBACK_CACHE"]].get(_fallback_key(url, params))
+    return decode(content) if content is not None else None
@@ -0,0 +1,52 @@
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .instrumentation import count
+from .models import CarModel
+
+
+# The cars a reviewer can pick on the add_review page: what the form shows of a CarModel
+CarChoice = namedtuple("CarChoice", ["id", "make", "name", "year"])
+
+# Default configuration of the car choices cache, overridden by settings.CAR_CHOICES_CACHE
+CACHE_DEFAULTS = {
+    "BACKEND": "default",   # CACHES alias, must be shared between workers to share the invalidation too
+    "TTL": 60 * 60,         # the longest a worker serves stale cars when its cache is not shared
+}
+
+VERSION_KEY = "car-choices:version"
+
+
+def _config():
+    return dict(CACHE_DEFAULTS, **getattr(settings, "CAR_CHOICES_CACHE", {}))
+
+
+# Returns the CarChoice list of a dealer's cars, loaded with one joined query and then cached
+# per dealer until the cars or makes change in the admin (see invalidate_car_choices)
+def get_car_choices(dealer_id):
+    config = _config()
+    cache = caches[config["BACKEND"]]
+    # The key embeds a version that invalidation bumps, which drops the cached cars of every dealer
+    version = cache.get_or_set(VERSION_KEY, 1, timeout=None)
+    key = "car-choices:{}:{}".format(version, dealer_id)
+    choices = cache.get(key)
+    if choices is None:
+        count("car_choices_cache_miss")
+        rows = (CarModel.objects.filter(dealer_id=dealer_id).order_by("car_make__name", "name")
+                .values_list("id", "car_make__name", "name", "year"))
+        choices = [CarChoice(*row) for row in rows]
+        cache.set(key, choices, config["TTL"])
+    else:
+        count("car_choices_cache_hit")
+    return choices
+
+
+def invalidate_car_choices():
+    cache = caches[_config()["BACKEND"]]
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        # No version yet, so nothing is cached
+        pass
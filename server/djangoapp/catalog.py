@@ -0,0 +1,179 @@
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from .geo import GeoIndex
+
+
+logger = logging.getLogger(__name__)
+
+
+class CachedCatalog:
+    # Keeps the result of `loader(previous)` for `ttl` seconds, `previous` being the value it replaces
+    # (None on the first load), so a loader can update the old value instead of rebuilding it.
+    # After the ttl the stale value is still returned while one background thread reloads it,
+    # so concurrent requests never wait for (or repeat) the upstream fetch. Only the very first
+    # load, and the first one after invalidate(), is done in the request.
+    def __init__(self, loader, ttl):
+        self.loader = loader
+        self.ttl = ttl
+        self._value = None
+        self._expires = 0
+        self._generation = 0
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._value is not None:
+                if self._expires <= time.monotonic() and not self._refreshing:
+                    self._refreshing = True
+                    threading.Thread(target=self._refresh, args=(self._generation,), daemon=True).start()
+                return self._value
+        # Nothing cached yet, the first caller loads it and the others wait for its result
+        with self._load_lock:
+            with self._lock:
+                if self._value is not None:
+                    return self._value
+                generation = self._generation
+            value = self.loader(None)
+            self._store(value, generation)
+            return value
+
+    def _refresh(self, generation):
+        try:
+            self._store(self.loader(self._value), generation)
+        except Exception:
+            # Keep serving the stale value, the next request after the ttl tries again
+            logger.exception("Refreshing the catalog failed")
+            with self._lock:
+                self._refreshing = False
+
+    def _store(self, value, generation):
+        with self._lock:
+            # A reload that started before invalidate() must not bring the old data back
+            if generation == self._generation:
+                self._value = value
+                self._expires = time.monotonic() + self.ttl
+            self._refreshing = False
+
+    # Drops the cached value, the next get() loads it again
+    def invalidate(self):
+        with self._lock:
+            self._value = None
+            self._generation += 1
+
+
+def _dealer_fields(dealer):
+    return (dealer.address, dealer.city, dealer.full_name, dealer.lat, dealer.long,
+            dealer.short_name, dealer.st, dealer.zip)
+
+
+def _group(dealers, attribute):
+    groups = {}
+    for dealer in dealers:
+        groups.setdefault(getattr(dealer, attribute), []).append(dealer)
+    return groups
+
+
+class DealerIndex:
+    # The full dealer list with hash indexes on id, state (st) and zip.
+    # The index holds the CarDealer objects themselves, no copies. An index is never changed once
+    # built, so requests can read it while a refresh builds the next one.
+    SORT_FIELDS = ("id", "full_name", "short_name", "city", "address", "zip", "st")
+
+    def __init__(self, dealers, by_id, by_state, by_zip):
+        self.dealers = dealers
+        self.by_id = by_id
+        self.by_state = by_state
+        self.by_zip = by_zip
+        self._geo = None
+        self._sorted = {}
+
+    # Spatial index over the dealers' lat/long, built on first use
+    @property
+    def geo(self):
+        if self._geo is None:
+            self._geo = GeoIndex.from_dealers(self.dealers)
+        return self._geo
+
+    # Returns (total, dealers) for one page of the dealers, optionally only those of one state,
+    # sorted by one of SORT_FIELDS. Every (state, sort) ordering is sorted once and then reused.
+    # Only the states of the index are cached, the state comes from the query string and unknown
+    # ones would grow the cache without bound.
+    def page(self, state=None, sort="id", descending=False, offset=0, limit=20):
+        if state is not None and state not in self.by_state:
+            return 0, []
+        key = (state, sort)
+        ordered = self._sorted.get(key)
+        if ordered is None:
+            dealers = self.dealers if state is None else self.by_state[state]
+            ordered = sorted(dealers, key=lambda dealer: getattr(dealer, sort))
+            self._sorted[key] = ordered
+        total = len(ordered)
+        if descending:
+            start, end = max(total - offset - limit, 0), max(total - offset, 0)
+            return total, ordered[start:end][::-1]
+        return total, ordered[offset:offset + limit]
+
+    @classmethod
+    def build(cls, dealers, previous=None):
+        # Returns the index of `dealers`. Given the index it replaces, only the dealers that were
+        # added, removed or changed are re-indexed and unchanged dealer objects are kept.
+        if previous is None:
+            return cls(list(dealers), {dealer.id: dealer for dealer in dealers},
+                       _group(dealers, "st"), _group(dealers, "zip"))
+        by_id = dict(previous.by_id)
+        changed = []
+        seen = set()
+        for dealer in dealers:
+            seen.add(dealer.id)
+            old = by_id.get(dealer.id)
+            if old is None or _dealer_fields(old) != _dealer_fields(dealer):
+                changed.append((old, dealer))
+                by_id[dealer.id] = dealer
+        removed = [by_id.pop(dealer_id) for dealer_id in list(by_id) if dealer_id not in seen]
+        if not changed and not removed:
+            return previous
+        # Rebuild only the state and zip buckets that lost or gained a dealer
+        states = {dealer.st for pair in changed for dealer in pair if dealer is not None}
+        zips = {dealer.zip for pair in changed for dealer in pair if dealer is not None}
+        states.update(dealer.st for dealer in removed)
+        zips.update(dealer.zip for dealer in removed)
+        kept = [by_id[dealer.id] for dealer in dealers]
+        by_state = dict(previous.by_state)
+        by_zip = dict(previous.by_zip)
+        for key in states:
+            by_state.pop(key, None)
+        for key in zips:
+            by_zip.pop(key, None)
+        by_state.update(_group((dealer for dealer in kept if dealer.st in states), "st"))
+        by_zip.update(_group((dealer for dealer in kept if dealer.zip in zips), "zip"))
+        return cls(kept, by_id, by_state, by_zip)
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+# Returns the catalog cached under `key`, created with `loader` on first use
+def get_catalog(key, loader):
+    catalog = _catalogs.get(key)
+    if catalog is None:
+        with _catalogs_lock:
+            catalog = _catalogs.get(key)
+            if catalog is None:
+                catalog = CachedCatalog(loader, getattr(settings, "DEALER_CATALOG_TTL", 300))
+                _catalogs[key] = catalog
+    return catalog
+
+
+# Invalidates the catalog cached under `key`, or every catalog
+def invalidate_catalog(key=None):
+    with _catalogs_lock:
+        catalogs = list(_catalogs.values()) if key is None else [_catalogs[key]] if key in _catalogs else []
+    for catalog in catalogs:
+        catalog.invalidate()
@@ -0,0 +1,238 @@
+import base64
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from django.conf import settings
+
+
+# A local stand-in for the dealership and review cloud functions.
+# It answers with the same response shapes restapis parses, from dealers and reviews kept in
+# an indexed SQLite database (in memory by default), seeded from cloudant/data:
+#   GET  /api/dealership                  {"body": {"rows": [{"id", "key", "doc"}, ...]}}
+#   GET  /api/dealership?state=TX         {"body": {"docs": [...]}}
+#   GET  /api/dealer?dealer_id=15         {"entries": {...}}
+#   GET  /api/review?dealerId=15&limit=20&bookmark=...
+#                                         {"body": {"data": {"docs": [...], "bookmark": "..."}}}
+#   POST /api/review  {"review": {...}}   {"ok": true, "id": "..."}
+# Docs are stored as JSON text and spliced into the responses without being parsed again.
+
+DATA_DIR = os.path.join(settings.BASE_DIR.parent, "cloudant", "data")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dealers (id INTEGER PRIMARY KEY, st TEXT, zip TEXT, doc TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS dealers_st ON dealers (st);
+CREATE INDEX IF NOT EXISTS dealers_zip ON dealers (zip);
+CREATE TABLE IF NOT EXISTS reviews (seq INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, dealership INTEGER, doc TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS reviews_dealership ON reviews (dealership, seq);
+CREATE TABLE IF NOT EXISTS imports (source TEXT PRIMARY KEY, signature TEXT, position INTEGER, rows INTEGER);
+"""
+
+
+def encode_bookmark(seq):
+    return base64.urlsafe_b64encode(str(seq).encode()).decode()
+
+
+def decode_bookmark(bookmark):
+    try:
+        return int(base64.urlsafe_b64decode(bookmark.encode()).decode())
+    except ValueError:
+        return 0
+
+
+class DataStore:
+    # Dealers and reviews in SQLite, indexed on dealer id, state and zip and on review dealership.
+    # One connection shared by the server threads, behind a lock.
+    def __init__(self, path=":memory:"):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.Lock()
+
+    # `progress` is an optional import checkpoint (see save_progress) committed with the rows
+    def add_dealers(self, dealers, progress=None):
+        rows = [(dealer["id"], dealer.get("st"), dealer.get("zip"), json.dumps(dealer)) for dealer in dealers]
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO dealers (id, st, zip, doc) VALUES (?, ?, ?, ?)", rows)
+            if progress:
+                self._save_progress(*progress)
+        return len(rows)
+
+    def add_reviews(self, reviews, progress=None):
+        rows = []
+        for review in reviews:
+            review = dict(review)
+            # Cloudant docs carry their id as a string in `_id`
+            review.setdefault("_id", str(review["id"]) if "id" in review else None)
+            rows.append((review["_id"], review.get("dealership"), review))
+        with self.lock, self.connection:
+            cursor = self.connection.cursor()
+            ids = []
+            for review_id, dealership, review in rows:
+                if review_id is None:
+                    cursor.execute("INSERT INTO reviews (id, dealership, doc) VALUES ('', ?, '')", (dealership,))
+                    review["_id"] = review_id = "review-{}".format(cursor.lastrowid)
+                    cursor.execute("UPDATE reviews SET id = ?, doc = ? WHERE seq = ?",
+                                   (review_id, json.dumps(review), cursor.lastrowid))
+                else:
+                    cursor.execute("INSERT OR REPLACE INTO reviews (id, dealership, doc) VALUES (?, ?, ?)",
+                                   (review_id, dealership, json.dumps(review)))
+                ids.append(review_id)
+            if progress:
+                self._save_progress(*progress)
+        return ids
+
+    # Import checkpoints: how far (a byte offset and a row count) the import of a source file got.
+    # The signature identifies the file's content (e.g. its size and mtime), a checkpoint of a
+    # file that changed since is ignored.
+    def _save_progress(self, source, signature, position, rows):
+        self.connection.execute("INSERT OR REPLACE INTO imports (source, signature, position, rows) VALUES (?, ?, ?, ?)",
+                                (source, signature, position, rows))
+
+    def save_progress(self, source, signature, position, rows):
+        with self.lock, self.connection:
+            self._save_progress(source, signature, position, rows)
+
+    def import_progress(self, source, signature):
+        rows = self._query("SELECT position, rows FROM imports WHERE source = ? AND signature = ?", (source, signature))
+        return rows[0] if rows else (0, 0)
+
+    def clear_progress(self, source):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM imports WHERE source = ?", (source,))
+
+    def seed(self, data_dir=DATA_DIR):
+        with open(os.path.join(data_dir, "dealerships.json")) as f:
+            self.add_dealers(json.load(f)["dealerships"])
+        with open(os.path.join(data_dir, "reviews-full.json")) as f:
+            self.add_reviews(json.load(f)["reviews"])
+
+    def _query(self, sql, params=()):
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def all_dealers(self):
+        return self._query("SELECT id, doc FROM dealers ORDER BY id")
+
+    def dealers_by_state(self, state):
+        return [doc for doc, in self._query("SELECT doc FROM dealers WHERE st = ? ORDER BY id", (state,))]
+
+    def dealer(self, dealer_id):
+        rows = self._query("SELECT doc FROM dealers WHERE id = ?", (dealer_id,))
+        return rows[0][0] if rows else None
+
+    # Yields the JSON docs of every dealer ("dealers") or review ("reviews") in batches of
+    # batch_size, without holding the whole table in memory
+    def iter_docs(self, kind, batch_size=1000):
+        key = {"dealers": "id", "reviews": "seq"}[kind]
+        last = None
+        while True:
+            if last is None:
+                rows = self._query("SELECT {0}, doc FROM {1} ORDER BY {0} LIMIT ?".format(key, kind), (batch_size,))
+            else:
+                rows = self._query("SELECT {0}, doc FROM {1} WHERE {0} > ? ORDER BY {0} LIMIT ?".format(key, kind),
+                                   (last, batch_size))
+            if not rows:
+                return
+            last = rows[-1][0]
+            yield [doc for _, doc in rows]
+
+    # Returns a page of the dealer's review docs and the bookmark of the next page
+    def reviews(self, dealer_id, limit=None, bookmark=None):
+        after = decode_bookmark(bookmark) if bookmark else 0
+        rows = self._query("SELECT seq, doc FROM reviews WHERE dealership = ? AND seq > ? ORDER BY seq LIMIT ?",
+                           (dealer_id, after, limit or -1))
+        next_bookmark = encode_bookmark(rows[-1][0]) if rows else bookmark
+        return [doc for _, doc in rows], next_bookmark
+
+
+class Faults:
+    # Failures injected into the data service's answers, to try the app against a failing
+    # upstream. Change the attributes at any time, e.g. faults.error_rate = 1 for an outage.
+    def __init__(self, error_rate=0.0, error_status=503, hang=0.0):
+        self.error_rate = error_rate      # share of the requests answered with error_status
+        self.error_status = error_status
+        self.hang = hang                  # extra seconds every request waits, e.g. past the client timeout
+
+    def inject(self, handler):
+        if self.hang:
+            time.sleep(self.hang)
+        if self.error_rate and random.random() < self.error_rate:
+            handler.send_json('{"error": "injected"}', self.error_status)
+            return True
+        return False
+
+
+def make_handler(store, delay=0.0, faults=None):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body are written separately, without TCP_NODELAY the body waits for a delayed ACK
+        disable_nagle_algorithm = True
+
+        def send_json(self, body, status=200):
+            body = body.encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if delay:
+                time.sleep(delay)
+            if faults and faults.inject(self):
+                return
+            parts = urlsplit(self.path)
+            query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+            path = parts.path.rstrip("/")
+            try:
+                if path.endswith("/review"):
+                    docs, bookmark = store.reviews(int(query["dealerId"]), int(query.get("limit") or 0) or None,
+                                                   query.get("bookmark"))
+                    return self.send_json('{"body": {"data": {"docs": [%s], "bookmark": %s}}}'
+                                          % (",".join(docs), json.dumps(bookmark)))
+                dealer_id = query.get("dealer_id") or query.get("dealerId")
+                if dealer_id is not None:
+                    doc = store.dealer(int(dealer_id))
+                    if doc is None:
+                        return self.send_json('{"error": "not_found"}', 404)
+                    return self.send_json('{"entries": %s}' % doc)
+                if "state" in query:
+                    return self.send_json('{"body": {"docs": [%s]}}' % ",".join(store.dealers_by_state(query["state"])))
+                rows = ",".join('{"id": "%d", "key": "%d", "doc": %s}' % (dealer_id, dealer_id, doc)
+                                for dealer_id, doc in store.all_dealers())
+                return self.send_json('{"body": {"rows": [%s]}}' % rows)
+            except (KeyError, ValueError):
+                return self.send_json('{"error": "bad_request"}', 400)
+
+        def do_POST(self):
+            if delay:
+                time.sleep(delay)
+            if faults and faults.inject(self):
+                return
+            if not urlsplit(self.path).path.rstrip("/").endswith("/review"):
+                return self.send_json('{"error": "not_found"}', 404)
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                review_id, = store.add_reviews([payload["review"]])
+            except (KeyError, ValueError, TypeError):
+                return self.send_json('{"error": "bad_request"}', 400)
+            return self.send_json(json.dumps({"ok": True, "id": review_id}))
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+# Starts the data service for `store` on a background thread and returns the server
+# (server.server_port is the port when port 0 picks a free one)
+def start_server(store, host="127.0.0.1", port=0, delay=0.0, faults=None):
+    server = ThreadingHTTPServer((host, port), make_handler(store, delay, faults))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,114 @@
+import codecs
+import json
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import orjson
+except ImportError:
+    # orjson is optional, the standard library decoder is used without it
+    orjson = None
+
+
+# JSON decoders by name, each takes the raw response bytes (no decoding to str first)
+DECODERS = {"json": json.loads}
+if orjson is not None:
+    DECODERS["orjson"] = orjson.loads
+
+_loads = None
+
+
+# Returns the decoder named by settings.JSON_DECODER, "auto" picks the fastest one installed
+def get_decoder():
+    global _loads
+    if _loads is None:
+        name = getattr(settings, "JSON_DECODER", "auto")
+        if name == "auto":
+            name = "orjson" if orjson is not None else "json"
+        if name not in DECODERS:
+            raise ImproperlyConfigured("JSON_DECODER {!r} is not available".format(name))
+        _loads = DECODERS[name]
+    return _loads
+
+
+# Decodes a whole JSON response body (bytes) with the decoder of settings.JSON_DECODER
+def decode(data):
+    return get_decoder()(data)
+
+
+# Streams the records of a JSON Lines file opened in binary mode, from byte offset `start`.
+# Yields (record, offset) pairs, offset being where the next record starts, so a reader can
+# resume after an interruption by passing the offset of the last record it kept.
+def iter_json_lines(f, start=0):
+    loads = get_decoder()
+    f.seek(start)
+    offset = start
+    for line in f:
+        offset += len(line)
+        if line.strip():
+            yield loads(line), offset
+
+
+# Streams the records of the first array in a JSON document opened in binary mode, e.g. the
+# dealers of {"dealerships": [...]}, reading chunk_size bytes at a time so that memory use
+# doesn't grow with the file. Yields (record, offset) pairs like iter_json_lines; a `start`
+# other than 0 must be an offset it yielded (a position inside the array).
+def iter_json_array(f, start=0, chunk_size=1 << 20):
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    f.seek(start)
+    buffer, position, offset, eof = "", 0, start, False
+
+    def fill():
+        nonlocal buffer, position, eof
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[position:] + text.decode(chunk, final=eof)
+        position = 0
+
+    # Find the opening bracket of the array, skipping over strings (keys) before it
+    in_array, in_string, escaped = start > 0, False, False
+    while not in_array:
+        if position >= len(buffer):
+            if eof:
+                return
+            fill()
+            continue
+        char = buffer[position]
+        position += 1
+        offset += len(char.encode())
+        if in_string:
+            in_string = escaped or char != '"'
+            escaped = not escaped and char == "\\"
+        else:
+            in_string = char == '"'
+            in_array = char == "["
+
+    while True:
+        # Skip the whitespace and commas between records
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+                offset += 1
+            if position < len(buffer) or eof:
+                break
+            fill()
+        if position >= len(buffer) or buffer[position] == "]":
+            return
+        try:
+            record, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # The record continues past the end of the buffer
+            if eof:
+                raise
+            fill()
+            continue
+        if not eof and (end == len(buffer) or buffer[end] not in " \t\r\n,]"):
+            # A record ends at a delimiter: a number cut by the end of the buffer (e.g. "-5." of
+            # "-5.5e3") decodes as its first digits, so read on until the delimiter is there
+            fill()
+            continue
+        offset += len(buffer[position:end].encode())
+        position = end
+        yield record, offset
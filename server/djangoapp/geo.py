@@ -0,0 +1,132 @@
+import heapq
+import math
+
+import numpy as np
+
+
+EARTH_RADIUS_KM = 6371.0088
+# Points per k-d tree leaf, leaves are scanned with NumPy
+LEAF_SIZE = 16
+
+
+def to_unit_vectors(lat, long):
+    # Maps latitudes/longitudes (degrees) to points on the unit sphere, where the straight
+    # (chord) distance between two points grows with their great-circle distance
+    lat = np.radians(np.asarray(lat, dtype=float))
+    long = np.radians(np.asarray(long, dtype=float))
+    return np.stack([np.cos(lat) * np.cos(long), np.cos(lat) * np.sin(long), np.sin(lat)], axis=-1)
+
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(np.asarray(chord) / 2, 1.0))
+
+
+def km_to_chord(km):
+    return 2 * math.sin(min(km / EARTH_RADIUS_KM, math.pi) / 2)
+
+
+def haversine_km(lat1, long1, lat2, long2):
+    lat1, long1, lat2, long2 = (np.radians(np.asarray(value, dtype=float)) for value in (lat1, long1, lat2, long2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((long2 - long1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+class GeoIndex:
+    # A k-d tree over the lat/long of a list of items (e.g. CarDealer objects).
+    # The points are stored as 3D unit vectors, so nearest and within-radius queries use
+    # plain euclidean distance and work across the poles and the date line.
+    def __init__(self, items, lat, long):
+        self.items = list(items)
+        self.points = to_unit_vectors(lat, long).reshape(-1, 3)
+        self.order = np.arange(len(self.items))
+        # Node lists: split axis and value, children (-1 for leaves), leaf range in self.order
+        self.axis = []
+        self.split = []
+        self.left = []
+        self.right = []
+        self.start = []
+        self.end = []
+        if self.items:
+            self._build(0, len(self.items))
+
+    @classmethod
+    def from_dealers(cls, dealers):
+        return cls(dealers, [float(dealer.lat) for dealer in dealers], [float(dealer.long) for dealer in dealers])
+
+    def _add_node(self, axis, split, start, end):
+        self.axis.append(axis)
+        self.split.append(split)
+        self.left.append(-1)
+        self.right.append(-1)
+        self.start.append(start)
+        self.end.append(end)
+        return len(self.axis) - 1
+
+    def _build(self, start, end):
+        if end - start <= LEAF_SIZE:
+            return self._add_node(-1, 0.0, start, end)
+        points = self.points[self.order[start:end]]
+        axis = int(np.argmax(points.max(axis=0) - points.min(axis=0)))
+        middle = (end - start) // 2
+        partition = np.argpartition(points[:, axis], middle)
+        self.order[start:end] = self.order[start:end][partition]
+        split = float(self.points[self.order[start + middle], axis])
+        node = self._add_node(axis, split, start, end)
+        self.left[node] = self._build(start, start + middle)
+        self.right[node] = self._build(start + middle, end)
+        return node
+
+    def _leaf_distances(self, node, point):
+        indexes = self.order[self.start[node]:self.end[node]]
+        return indexes, np.sqrt(((self.points[indexes] - point) ** 2).sum(axis=1))
+
+    # Returns the k nearest items as (item, distance in km) pairs, nearest first
+    def nearest(self, lat, long, k=5):
+        if not self.items or k <= 0:
+            return []
+        point = to_unit_vectors(lat, long)
+        # Max-heap (negated distances) of the best k found so far
+        best = []
+        stack = [(0, 0.0)]
+        while stack:
+            node, bound = stack.pop()
+            if len(best) == k and bound >= -best[0][0]:
+                continue
+            if self.axis[node] < 0:
+                indexes, distances = self._leaf_distances(node, point)
+                for index, distance in zip(indexes.tolist(), distances.tolist()):
+                    if len(best) < k:
+                        heapq.heappush(best, (-distance, index))
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best, (-distance, index))
+                continue
+            difference = point[self.axis[node]] - self.split[node]
+            near, far = (self.left[node], self.right[node]) if difference < 0 else (self.right[node], self.left[node])
+            # The far side can only hold points at least |difference| away, visit the near side first
+            stack.append((far, max(bound, abs(difference))))
+            stack.append((near, bound))
+        best.sort(reverse=True)
+        return [(self.items[index], float(chord_to_km(-distance))) for distance, index in best]
+
+    # Returns every item within radius_km as (item, distance in km) pairs, nearest first
+    def within(self, lat, long, radius_km):
+        if not self.items:
+            return []
+        point = to_unit_vectors(lat, long)
+        radius = km_to_chord(radius_km)
+        found = []
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if self.axis[node] < 0:
+                indexes, distances = self._leaf_distances(node, point)
+                inside = distances <= radius
+                found.extend(zip(distances[inside].tolist(), indexes[inside].tolist()))
+                continue
+            difference = point[self.axis[node]] - self.split[node]
+            if difference - radius <= 0:
+                stack.append(self.left[node])
+            if difference + radius >= 0:
+                stack.append(self.right[node])
+        found.sort()
+        return [(self.items[index], float(chord_to_km(distance))) for distance, index in found]
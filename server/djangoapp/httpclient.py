@@ -0,0 +1,147 @@
+import asyncio
+import threading
+import weakref
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .instrumentation import count
+
+
+# Default configuration of the upstream HTTP client, overridden by settings.RESTAPI_CLIENT
+DEFAULTS = {
+    "POOL_SIZE": 10,        # connections kept alive per host
+    "POOL_SIZES": {},       # per-host overrides, e.g. {"9bebcb01.eu-de.apigw.appdomain.cloud": 20}
+    "CONNECT_TIMEOUT": 3.05,
+    "READ_TIMEOUT": 10,
+    "RETRIES": 2,           # retries of idempotent requests on connection errors and 502/503/504
+    "BACKOFF_FACTOR": 0.3,  # sleeps 0.3s, 0.6s, 1.2s, ... between retries
+}
+
+
+class HttpClient:
+    # A pooled, keep-alive HTTP client shared by every upstream call of the process.
+    # Each host gets its own connection pool (sized from POOL_SIZES or POOL_SIZE), so
+    # repeated calls to the API gateway reuse an open TCP+TLS connection.
+    def __init__(self, config=None):
+        self.config = dict(DEFAULTS, **(config or {}))
+        self.timeout = (self.config["CONNECT_TIMEOUT"], self.config["READ_TIMEOUT"])
+        self.session = requests.Session()
+        self._mounted = set()
+        self._lock = threading.Lock()
+
+    def _retry(self):
+        # Only GET is retried, a POST may not be safe to send twice
+        return Retry(total=self.config["RETRIES"], backoff_factor=self.config["BACKOFF_FACTOR"],
+                     status_forcelist=(502, 503, 504), allowed_methods=frozenset(["GET", "HEAD"]),
+                     raise_on_status=False)
+
+    def _mount(self, url):
+        # Lazily mount a dedicated adapter (connection pool) for the host of the url
+        parts = urlsplit(url)
+        prefix = "{}://{}/".format(parts.scheme, parts.netloc)
+        if prefix in self._mounted:
+            return
+        with self._lock:
+            if prefix in self._mounted:
+                return
+            pool_size = self.config["POOL_SIZES"].get(parts.hostname, self.config["POOL_SIZE"])
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=self._retry())
+            self.session.mount(prefix, adapter)
+            self._mounted.add(prefix)
+
+    def request(self, method, url, **kwargs):
+        self._mount(url)
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncHttpClient:
+    # The asyncio counterpart of HttpClient, used by the async views.
+    # It has the same per-host pool sizes, timeouts and retry policy, with one httpx.AsyncClient
+    # per host and event loop (an httpx client can't be shared between event loops).
+    def __init__(self, config=None):
+        self.config = dict(DEFAULTS, **(config or {}))
+        self.timeout = httpx.Timeout(self.config["READ_TIMEOUT"], connect=self.config["CONNECT_TIMEOUT"])
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _client(self, url):
+        parts = urlsplit(url)
+        clients = self._clients.setdefault(asyncio.get_running_loop(), {})
+        client = clients.get(parts.netloc)
+        if client is None:
+            pool_size = self.config["POOL_SIZES"].get(parts.hostname, self.config["POOL_SIZE"])
+            # Like the requests pools, extra connections can be opened but only pool_size are kept alive
+            limits = httpx.Limits(max_connections=None, max_keepalive_connections=pool_size)
+            client = httpx.AsyncClient(timeout=self.timeout, limits=limits)
+            clients[parts.netloc] = client
+        return client
+
+    async def request(self, method, url, **kwargs):
+        client = self._client(url)
+        # Only GET is retried, a POST may not be safe to send twice
+        retries = self.config["RETRIES"] if method in ("GET", "HEAD") else 0
+        for attempt in range(retries + 1):
+            try:
+                response = await client.request(method, url, **kwargs)
+                if response.status_code not in (502, 503, 504) or attempt == retries:
+                    return response
+            except httpx.TransportError:
+                if attempt == retries:
+                    raise
+            count("upstream_retry")
+            await asyncio.sleep(self.config["BACKOFF_FACTOR"] * (2 ** attempt))
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+
+_client = None
+_async_client = None
+_client_lock = threading.Lock()
+
+
+# Returns the process-wide client, created on first use from settings.RESTAPI_CLIENT
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = HttpClient(getattr(settings, "RESTAPI_CLIENT", None))
+    return _client
+
+
+# Returns the process-wide async client, created on first use from settings.RESTAPI_CLIENT
+def get_async_client():
+    global _async_client
+    if _async_client is None:
+        with _client_lock:
+            if _async_client is None:
+                _async_client = AsyncHttpClient(getattr(settings, "RESTAPI_CLIENT", None))
+    return _async_client
+
+
+# Drops the process-wide clients, e.g. after the settings changed in a test
+def reset_client():
+    global _client, _async_client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = None
+        _async_client = None
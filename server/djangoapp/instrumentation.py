@@ -0,0 +1,224 @@
+import bisect
+import contextvars
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+
+# Timing spans and counters of the hot path: upstream calls, JSON decoding, sentiment analysis,
+# ORM queries and template rendering, plus cache hits, retries and the like.
+# Spans feed process-wide histograms (see snapshot(), served by the metrics view) and, inside a
+# request, the Server-Timing header added by ServerTimingMiddleware.
+# Everything is off unless settings.INSTRUMENTATION is set: span() then returns a shared no-op
+# context manager and count() returns at once.
+
+# Upper bounds (ms) of the histogram buckets, the last bucket counts everything above
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+_enabled = None
+_request_spans = contextvars.ContextVar("request_spans", default=None)
+
+
+def enabled():
+    global _enabled
+    if _enabled is None:
+        _enabled = bool(getattr(settings, "INSTRUMENTATION", False))
+    return _enabled
+
+
+# Turns the instrumentation on or off at runtime, e.g. in a test
+def set_enabled(value):
+    global _enabled
+    _enabled = bool(value)
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, ms):
+        self.buckets[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.sum_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+    # The value below which `quantile` of the observations fall, as the upper bound of its bucket
+    def quantile(self, quantile):
+        rank = quantile * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS_MS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum_ms": round(self.sum_ms, 3),
+            "mean_ms": round(self.sum_ms / self.count, 3) if self.count else 0.0,
+            "max_ms": round(self.max_ms, 3),
+            "p50_ms": round(self.quantile(0.5), 3),
+            "p95_ms": round(self.quantile(0.95), 3),
+            "p99_ms": round(self.quantile(0.99), 3),
+            "buckets": {("le_{}".format(bound) if bound else "inf"): count
+                        for bound, count in zip(BUCKETS_MS + (None,), self.buckets)},
+        }
+
+
+class Metrics:
+    # Process-wide histograms of span durations and counters, by name
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, ms):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(ms)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            return {"spans": {name: histogram.to_dict() for name, histogram in sorted(self.histograms.items())},
+                    "counters": dict(sorted(self.counters.items()))}
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+
+metrics = Metrics()
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+# Times the block under `name`: with span("upstream_get"): ...
+def span(name):
+    if not enabled():
+        return _NO_SPAN
+    return _Span(name)
+
+
+# Records a duration (in seconds) measured elsewhere, e.g. by a database execute wrapper
+def record(name, seconds):
+    ms = seconds * 1000
+    metrics.observe(name, ms)
+    spans = _request_spans.get()
+    if spans is not None:
+        # Appending is atomic, so threads sharing the request's context can add spans safely
+        spans.append((name, ms))
+
+
+def count(name, value=1):
+    if enabled():
+        metrics.count(name, value)
+
+
+# Times every ORM query, installed on each database connection (see apps.py)
+def query_wrapper(execute, sql, params, many, context):
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        record("db_query", time.perf_counter() - start)
+
+
+def server_timing_header(spans, total_ms):
+    totals = {}
+    for name, ms in spans:
+        entry = totals.setdefault(name, [0.0, 0])
+        entry[0] += ms
+        entry[1] += 1
+    metrics_ = ['{};dur={:.1f};desc="{} call{}"'.format(name, ms, calls, "" if calls == 1 else "s")
+                for name, (ms, calls) in totals.items()]
+    metrics_.append("total;dur={:.1f}".format(total_ms))
+    return ", ".join(metrics_)
+
+
+# Adds a Server-Timing header with the time of each kind of span of the request (summed, with
+# the number of calls) and the total, and records the request time in the "request" histogram.
+# Works for sync (WSGI) and async (ASGI) stacks.
+class ServerTimingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not enabled():
+            return self.get_response(request)
+        start, token = self._start()
+        try:
+            response = self.get_response(request)
+        finally:
+            spans = self._finish(start, token)
+        response["Server-Timing"] = server_timing_header(*spans)
+        return response
+
+    async def __acall__(self, request):
+        if not enabled():
+            return await self.get_response(request)
+        start, token = self._start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            spans = self._finish(start, token)
+        response["Server-Timing"] = server_timing_header(*spans)
+        return response
+
+    def _start(self):
+        return time.perf_counter(), _request_spans.set([])
+
+    def _finish(self, start, token):
+        total_ms = (time.perf_counter() - start) * 1000
+        spans = _request_spans.get()
+        _request_spans.reset(token)
+        metrics.observe("request", total_ms)
+        return spans, total_ms
+
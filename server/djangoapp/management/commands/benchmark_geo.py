@@ -0,0 +1,57 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from djangoapp.geo import GeoIndex, haversine_km
+
+
+class Command(BaseCommand):
+    help = "Compares the dealer GeoIndex with a brute-force haversine scan on a synthetic catalog"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--size", type=int, default=100000, help="number of synthetic dealers")
+        parser.add_argument("--queries", type=int, default=1000)
+        parser.add_argument("--k", type=int, default=5)
+        parser.add_argument("--radius", type=float, default=25.0, help="radius of the within queries in km")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options["seed"])
+        size, queries, k, radius = options["size"], options["queries"], options["k"], options["radius"]
+        # Dealers and query points spread over the continental US
+        lat = rng.uniform(25, 49, size)
+        long = rng.uniform(-124, -67, size)
+        query_lat = rng.uniform(25, 49, queries)
+        query_long = rng.uniform(-124, -67, queries)
+
+        start = time.perf_counter()
+        index = GeoIndex(range(size), lat, long)
+        build = time.perf_counter() - start
+        self.stdout.write("Built index of {} dealers in {:.1f} ms".format(size, build * 1000))
+
+        def brute_nearest(a, b):
+            distances = haversine_km(a, b, lat, long)
+            return np.argpartition(distances, k)[:k] if size > k else np.arange(size)
+
+        def brute_within(a, b):
+            return np.flatnonzero(haversine_km(a, b, lat, long) <= radius)
+
+        runs = [
+            ("nearest k={}".format(k), lambda a, b: index.nearest(a, b, k), brute_nearest),
+            ("within {} km".format(radius), lambda a, b: index.within(a, b, radius), brute_within),
+        ]
+        for name, indexed, brute in runs:
+            mismatches = 0
+            timings = {}
+            for label, query in (("index", indexed), ("brute force", brute)):
+                start = time.perf_counter()
+                results = [query(a, b) for a, b in zip(query_lat, query_long)]
+                timings[label] = (time.perf_counter() - start) / queries
+                if label == "index":
+                    found = [{item for item, _ in result} for result in results]
+                else:
+                    mismatches = sum(set(result.tolist()) != expected for result, expected in zip(results, found))
+            self.stdout.write("{}: index {:.3f} ms/query, brute force {:.3f} ms/query, {:.1f}x faster, "
+                              "{} mismatches".format(name, timings["index"] * 1000, timings["brute force"] * 1000,
+                                                     timings["brute force"] / timings["index"], mismatches))
@@ -0,0 +1,65 @@
+import gc
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from djangoapp.models import CarDealer, CarDealerColumns
+
+
+class DictCarDealer:
+    # CarDealer as it was before __slots__: a __dict__ per object, built with keyword arguments
+    def __init__(self, address, city, full_name, id, lat, long, short_name, st, zip):
+        self.address = address
+        self.city = city
+        self.full_name = full_name
+        self.id = id
+        self.lat = lat
+        self.long = long
+        self.short_name = short_name
+        self.st = st
+        self.zip = zip
+
+
+def build_with_keywords(docs):
+    return [DictCarDealer(address=doc["address"], city=doc["city"], full_name=doc["full_name"],
+                          id=doc["id"], lat=doc["lat"], long=doc["long"], short_name=doc["short_name"],
+                          st=doc["st"], zip=doc["zip"]) for doc in docs]
+
+
+class Command(BaseCommand):
+    help = "Compares construction time and memory of the dealer representations"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--size", type=int, default=100000, help="number of synthetic dealers")
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        size = options["size"]
+        docs = [{"id": i, "city": "City {}".format(i % 500), "st": "S{}".format(i % 50),
+                 "address": "{} Main Street".format(i), "zip": "{:05d}".format(i % 99999),
+                 "lat": 25 + (i % 2400) / 100, "long": -124 + (i % 5700) / 100,
+                 "short_name": "Dealer{}".format(i), "full_name": "Dealer{} Car Dealership".format(i)}
+                for i in range(size)]
+        runs = [
+            ("dict-backed, keyword arguments", build_with_keywords),
+            ("slotted, CarDealer.from_rows", CarDealer.from_rows),
+            ("columnar, CarDealerColumns.from_rows", CarDealerColumns.from_rows),
+        ]
+        for name, build in runs:
+            best = float("inf")
+            for _ in range(options["repeat"]):
+                gc.collect()
+                start = time.perf_counter()
+                dealers = build(docs)
+                best = min(best, time.perf_counter() - start)
+                del dealers
+            # Memory of the containers and objects only: the field values are shared with the docs
+            gc.collect()
+            tracemalloc.start()
+            dealers = build(docs)
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del dealers
+            self.stdout.write("{}: {:.1f} ms, {:.1f} MB, {:.0f} bytes per dealer".format(
+                name, best * 1000, memory / 2 ** 20, memory / size))
@@ -0,0 +1,79 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases
+
+from djangoapp.dataservice import DataStore, start_server
+from djangoapp.models import Review
+
+WORDS = ["great", "service", "friendly", "terrible", "slow", "car", "price", "staff", "helpful", "bad"]
+
+
+def synthetic_review(number, dealers, rng):
+    return {"_id": str(number), "dealership": rng.randint(1, dealers), "name": "Reviewer {}".format(number),
+            "purchase": rng.random() < 0.5, "review": " ".join(rng.choices(WORDS, k=8)),
+            "purchase_date": "{:02d}/{:02d}/20{:02d}".format(rng.randint(1, 12), rng.randint(1, 28), rng.randint(10, 22)),
+            "car_make": "Make {}".format(number % 40), "car_model": "Model {}".format(number % 300),
+            "car_year": 2000 + number % 22, "sentiment": rng.choice(["positive", "neutral", "negative"])}
+
+
+class Command(BaseCommand):
+    help = ("Compares dealer page latency with reviews read from the get-review cloud function (the local data "
+            "service) and from the Review table, on a seeded test database")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--size", type=int, default=1000000, help="number of seeded reviews")
+        parser.add_argument("--dealers", type=int, default=1000)
+        parser.add_argument("--requests", type=int, default=200, help="dealer pages requested per source")
+        parser.add_argument("--upstream-delay", type=float, default=0.0,
+                            help="seconds the data service waits per call, e.g. the API gateway's latency")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        # The reviews go to a throwaway test database, not the project's
+        setup_test_environment()
+        databases = setup_databases(verbosity=0, interactive=False, aliases={"default"})
+        try:
+            self.run(options)
+        finally:
+            teardown_databases(databases, verbosity=0)
+
+    def run(self, options):
+        rng = random.Random(options["seed"])
+        size, dealers = options["size"], options["dealers"]
+        store = DataStore()
+        store.add_dealers({"id": i, "full_name": "Dealer {}".format(i), "short_name": "D{}".format(i),
+                           "address": "{} Main Street".format(i), "city": "City", "st": "TX", "zip": "75001",
+                           "lat": 32.0, "long": -96.0} for i in range(1, dealers + 1))
+        start = time.perf_counter()
+        for first in range(1, size + 1, 10000):
+            batch = [synthetic_review(number, dealers, rng) for number in range(first, min(first + 10000, size + 1))]
+            Review.objects.bulk_create([Review.from_doc(doc) for doc in batch])
+            store.add_reviews(batch)
+        self.stdout.write("Seeded {} reviews of {} dealers in {:.1f} s".format(size, dealers,
+                                                                                time.perf_counter() - start))
+
+        server = start_server(store, delay=options["upstream_delay"])
+        base = "http://127.0.0.1:{}/api".format(server.server_port)
+        paths = ["/djangoapp/dealer/{}/".format(rng.randint(1, dealers)) for _ in range(options["requests"])]
+        try:
+            for source in ("remote", "database"):
+                with override_settings(REVIEWS_SOURCE=source, DEALERSHIPS_URL=base + "/dealership",
+                                       REVIEWS_URL=base + "/review", DEALER_URL=base + "/dealer",
+                                       ALLOWED_HOSTS=["*"]):
+                    client = Client()
+                    client.get(paths[0])
+                    latencies = []
+                    for path in paths:
+                        start = time.perf_counter()
+                        client.get(path)
+                        latencies.append(time.perf_counter() - start)
+                latencies.sort()
+                self.stdout.write("{}: mean {:.1f} ms, p50 {:.1f} ms, p95 {:.1f} ms per dealer page".format(
+                    source, statistics.mean(latencies) * 1000, statistics.median(latencies) * 1000,
+                    latencies[int(len(latencies) * 0.95) - 1] * 1000))
+        finally:
+            server.shutdown()
@@ -0,0 +1,141 @@
+import json
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from djangoapp.dataservice import DataStore
+from djangoapp.decoders import iter_json_array, iter_json_lines
+from djangoapp.models import Review
+
+# Top-level key of the records in a JSON (not JSON Lines) file, as in cloudant/data
+ROOT_KEYS = {"dealers": "dealerships", "reviews": "reviews"}
+
+
+def is_json_lines(path):
+    return path.endswith((".jsonl", ".ndjson"))
+
+
+class Command(BaseCommand):
+    help = ("Streams dealers or reviews from a JSON file ({\"dealerships\": [...]} / {\"reviews\": [...]}, "
+            "like cloudant/data) or a JSON Lines file (.jsonl) into the data service database, or exports them "
+            "back. An interrupted import resumes where its last batch ended when run again. Reviews can also "
+            "go to the Review table of the Django database (--store database).")
+
+    def add_arguments(self, parser):
+        parser.add_argument("action", choices=["import", "export"])
+        parser.add_argument("kind", choices=["dealers", "reviews"])
+        parser.add_argument("path", help="file to read or write, '.jsonl' for JSON Lines")
+        parser.add_argument("--store", choices=["dataservice", "database"], default="dataservice",
+                            help="the data service database, or the Review table of the Django database")
+        parser.add_argument("--db", default=settings.DATASERVICE_DB,
+                            help="SQLite database of the data service, also keeps the import checkpoints")
+        parser.add_argument("--batch-size", type=int, default=5000, help="rows inserted per transaction")
+        parser.add_argument("--sentiment", action="store_true",
+                            help="analyze reviews without a sentiment while importing them")
+        parser.add_argument("--restart", action="store_true", help="ignore the checkpoint of an earlier import")
+
+    def handle(self, *args, **options):
+        if options["store"] == "database" and options["kind"] != "reviews":
+            raise CommandError("Only reviews are stored in the Django database")
+        store = DataStore(options["db"])
+        if options["action"] == "import":
+            self.import_file(store, options)
+        else:
+            self.export_file(store, options)
+
+    def import_file(self, store, options):
+        kind, path, batch_size = options["kind"], os.path.abspath(options["path"]), options["batch_size"]
+        if not os.path.exists(path):
+            raise CommandError("{} does not exist".format(path))
+        source = "{}:{}".format(kind, path)
+        stat = os.stat(path)
+        signature = "{}:{}".format(stat.st_size, stat.st_mtime_ns)
+        if options["restart"]:
+            store.clear_progress(source)
+        position, done = store.import_progress(source, signature)
+        if position:
+            self.stdout.write("Resuming {} after {} rows".format(path, done))
+        if options["store"] == "database":
+            def add(batch, progress=None):
+                self.add_to_database(batch)
+                if progress:
+                    store.save_progress(*progress)
+        else:
+            add = store.add_dealers if kind == "dealers" else store.add_reviews
+        records = iter_json_lines if is_json_lines(path) else iter_json_array
+
+        start = time.perf_counter()
+        imported = 0
+        with open(path, "rb") as f:
+            batch = []
+            for record, position in records(f, position):
+                batch.append(record)
+                if len(batch) == batch_size:
+                    imported += self.write_batch(add, batch, (source, signature, position, done + imported + len(batch)),
+                                                 options)
+                    batch = []
+                    self.report(imported, start)
+            if batch:
+                imported += self.write_batch(add, batch, None, options)
+        store.clear_progress(source)
+        self.report(imported, start, final=True)
+
+    def write_batch(self, add, batch, progress, options):
+        if options["sentiment"] and options["kind"] == "reviews":
+            # Imported here, restapis needs the sentiment settings only when they're used
+            from djangoapp.restapis import analyze_review_sentiments_batch
+            missing = [review for review in batch if not review.get("sentiment") and review.get("review")]
+            sentiments = analyze_review_sentiments_batch([review["review"] for review in missing])
+            for review, sentiment in zip(missing, sentiments):
+                review["sentiment"] = sentiment
+        add(batch, progress=progress)
+        return len(batch)
+
+    # Inserts a batch of review docs into the Review table, updating the reviews already there,
+    # so a batch imported again after an interruption doesn't duplicate them
+    def add_to_database(self, batch):
+        reviews = [Review.from_doc(doc) for doc in batch]
+        fields = [field.name for field in Review._meta.concrete_fields if field.name not in ("id", "review_id")]
+        with transaction.atomic():
+            Review.objects.bulk_create(reviews, update_conflicts=True, unique_fields=["review_id"],
+                                       update_fields=fields)
+
+    def report(self, rows, start, final=False):
+        elapsed = time.perf_counter() - start
+        self.stdout.write("{} {} rows in {:.1f} s, {:.0f} rows/s".format(
+            "Imported" if final else "...", rows, elapsed, rows / elapsed if elapsed else 0))
+
+    def export_file(self, store, options):
+        kind, path = options["kind"], options["path"]
+        json_lines = is_json_lines(path)
+        start = time.perf_counter()
+        exported = 0
+        # Docs are stored as JSON text and written out as they are
+        with open(path, "w", encoding="utf-8") as f:
+            if not json_lines:
+                f.write('{{"{}": [\n'.format(ROOT_KEYS[kind]))
+            batches = (self.iter_database_docs(options["batch_size"]) if options["store"] == "database"
+                       else store.iter_docs(kind, options["batch_size"]))
+            for docs in batches:
+                if json_lines:
+                    f.write("\n".join(docs) + "\n")
+                else:
+                    f.write(("" if not exported else ",\n") + ",\n".join(docs))
+                exported += len(docs)
+            if not json_lines:
+                f.write("\n]}\n")
+        elapsed = time.perf_counter() - start
+        self.stdout.write("Exported {} rows in {:.1f} s, {:.0f} rows/s".format(
+            exported, elapsed, exported / elapsed if elapsed else 0))
+
+    def iter_database_docs(self, batch_size):
+        last = 0
+        while True:
+            reviews = list(Review.objects.filter(id__gt=last).order_by("id")[:batch_size])
+            if not reviews:
+                return
+            last = reviews[-1].id
+            yield [json.dumps(review.to_doc()) for review in reviews]
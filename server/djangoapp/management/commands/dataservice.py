@@ -0,0 +1,38 @@
+from http.server import ThreadingHTTPServer
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from djangoapp.dataservice import DATA_DIR, DataStore, Faults, make_handler
+
+
+class Command(BaseCommand):
+    help = ("Runs the local stand-in for the dealership and review cloud functions, "
+            "e.g. DEALERSHIPS_URL=http://localhost:8100/api/dealership")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8100)
+        parser.add_argument("--db", default=settings.DATASERVICE_DB, help="SQLite database file, ':memory:' for none")
+        parser.add_argument("--data-dir", default=DATA_DIR, help="directory of dealerships.json and reviews-full.json")
+        parser.add_argument("--no-seed", action="store_true", help="don't load the data files into an empty database")
+        parser.add_argument("--delay", type=float, default=0.0, help="seconds to wait before each answer")
+        parser.add_argument("--error-rate", type=float, default=0.0,
+                            help="share of the requests answered with --error-status, to test failure handling")
+        parser.add_argument("--error-status", type=int, default=503)
+        parser.add_argument("--hang", type=float, default=0.0, help="extra seconds every request waits")
+
+    def handle(self, *args, **options):
+        store = DataStore(options["db"])
+        if not options["no_seed"] and next(store.iter_docs("dealers", 1), None) is None:
+            store.seed(options["data_dir"])
+        server = ThreadingHTTPServer((options["host"], options["port"]), make_handler(
+            store, options["delay"], Faults(options["error_rate"], options["error_status"], options["hang"])))
+        server.daemon_threads = True
+        self.stdout.write("Serving dealers and reviews on http://{}:{}/api/".format(options["host"], options["port"]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
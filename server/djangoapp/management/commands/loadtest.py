@@ -0,0 +1,102 @@
+import asyncio
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from djangoapp.dataservice import DataStore, start_server
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class Command(BaseCommand):
+    help = ("Load tests a dealer page under WSGI (gunicorn) and ASGI (uvicorn) against the local data "
+            "service, answering after a delay like a remote upstream")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--mode", choices=["wsgi", "asgi", "both"], default="both")
+        parser.add_argument("--path", default="/djangoapp/dealer/15/", help="page to request")
+        parser.add_argument("--requests", type=int, default=500)
+        parser.add_argument("--concurrency", type=int, default=100)
+        parser.add_argument("--workers", type=int, default=1, help="server worker processes")
+        parser.add_argument("--upstream-delay", type=float, default=0.2, help="seconds the data service waits per call")
+
+    def handle(self, *args, **options):
+        store = DataStore()
+        store.seed()
+        upstream = start_server(store, delay=options["upstream_delay"])
+        upstream_url = "http://127.0.0.1:{}".format(upstream.server_port)
+        modes = ["wsgi", "asgi"] if options["mode"] == "both" else [options["mode"]]
+        try:
+            for mode in modes:
+                self.run(mode, upstream_url, options)
+        finally:
+            upstream.shutdown()
+
+    def run(self, mode, upstream_url, options):
+        port = free_port()
+        env = dict(os.environ, DEALERSHIPS_URL=upstream_url + "/api/dealership",
+                   REVIEWS_URL=upstream_url + "/api/review", DEALER_URL=upstream_url + "/api/dealer",
+                   SENTIMENT_BACKEND="local", ASYNC_VIEWS="1" if mode == "asgi" else "0")
+        if mode == "wsgi":
+            command = ["gunicorn", "--bind", "127.0.0.1:{}".format(port), "--workers", str(options["workers"]),
+                       "--threads", "1", "djangobackend.wsgi"]
+        else:
+            command = [sys.executable, "-m", "uvicorn", "--port", str(port), "--workers", str(options["workers"]),
+                       "--log-level", "warning", "djangobackend.asgi:application"]
+        server = subprocess.Popen(command, cwd=settings.BASE_DIR, env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            url = "http://localhost:{}{}".format(port, options["path"])
+            latencies, errors, elapsed = asyncio.run(self.load(url, options["requests"], options["concurrency"]))
+        finally:
+            server.terminate()
+            server.wait()
+        if not latencies:
+            self.stdout.write("{}: every request failed ({} errors)".format(mode, errors))
+            return
+        latencies.sort()
+        self.stdout.write("{}: {} requests, concurrency {}, {:.1f} req/s, p50 {:.0f} ms, p95 {:.0f} ms, "
+                          "max {:.0f} ms, {} errors".format(
+                              mode, options["requests"], options["concurrency"], len(latencies) / elapsed,
+                              statistics.median(latencies) * 1000,
+                              latencies[int(len(latencies) * 0.95) - 1] * 1000, latencies[-1] * 1000, errors))
+
+    async def load(self, url, total, concurrency):
+        limits = httpx.Limits(max_connections=concurrency)
+        async with httpx.AsyncClient(timeout=60, limits=limits) as client:
+            # Wait for the server to come up, then warm it (and its caches) with one request
+            for _ in range(100):
+                try:
+                    await client.get(url)
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+            semaphore = asyncio.Semaphore(concurrency)
+            latencies = []
+            errors = 0
+
+            async def one():
+                nonlocal errors
+                async with semaphore:
+                    start = time.perf_counter()
+                    try:
+                        response = await client.get(url)
+                        response.raise_for_status()
+                        latencies.append(time.perf_counter() - start)
+                    except httpx.HTTPError:
+                        errors += 1
+
+            start = time.perf_counter()
+            await asyncio.gather(*(one() for _ in range(total)))
+            return latencies, errors, time.perf_counter() - start
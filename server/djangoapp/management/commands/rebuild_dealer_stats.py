@@ -0,0 +1,70 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, Q
+
+from djangoapp.models import DealerStats, Review
+from djangoapp.restapis import analyze_review_sentiments_batch, get_dealer_index, get_fetch_executor, get_request
+
+
+class Command(BaseCommand):
+    help = ("Rebuilds the review aggregates of every dealer (DealerStats) from the Review table, or from the "
+            "get-review cloud function")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--source", choices=["database", "remote"], default="database")
+        parser.add_argument("--analyze", action="store_true",
+                            help="with --source remote, analyze reviews without a sentiment instead of "
+                                 "counting them as neutral")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        if options["source"] == "database":
+            stats = self.from_database()
+        else:
+            stats = self.from_remote(options["analyze"])
+        with transaction.atomic():
+            DealerStats.objects.all().delete()
+            DealerStats.objects.bulk_create(stats, batch_size=1000)
+        self.stdout.write("Rebuilt the review aggregates of {} dealers ({} reviews) in {:.1f} s".format(
+            len(stats), sum(dealer_stats.reviews for dealer_stats in stats), time.perf_counter() - start))
+
+    def from_database(self):
+        # Two grouped queries: the counts by dealer, and the reviews by dealer and car make
+        stats = {}
+        counts = Review.objects.values("dealership").annotate(
+            reviews=Count("id"), positive=Count("id", filter=Q(sentiment="positive")),
+            negative=Count("id", filter=Q(sentiment="negative")), purchases=Count("id", filter=Q(purchase=True)))
+        for row in counts:
+            stats[row["dealership"]] = DealerStats(
+                dealership=row["dealership"], reviews=row["reviews"], positive=row["positive"],
+                negative=row["negative"], neutral=row["reviews"] - row["positive"] - row["negative"],
+                purchases=row["purchases"], make_counts={})
+        makes = (Review.objects.exclude(car_make=None).values_list("dealership", "car_make")
+                 .annotate(count=Count("id")))
+        for dealership, make, count in makes:
+            stats[dealership].make_counts[make] = count
+        return list(stats.values())
+
+    def from_remote(self, analyze):
+        dealers = get_dealer_index(settings.DEALERSHIPS_URL).dealers
+
+        def dealer_reviews(dealer):
+            json_result = get_request(settings.REVIEWS_URL, dealerId=dealer.id)
+            return json_result["body"]["data"]["docs"] if json_result else []
+
+        stats = []
+        for dealer, docs in zip(dealers, get_fetch_executor().map(dealer_reviews, dealers)):
+            if not docs:
+                continue
+            if analyze:
+                missing = [doc for doc in docs if not doc.get("sentiment")]
+                for doc, sentiment in zip(missing, analyze_review_sentiments_batch([doc["review"] for doc in missing])):
+                    doc["sentiment"] = sentiment
+            dealer_stats = DealerStats(dealership=dealer.id, make_counts={})
+            for doc in docs:
+                dealer_stats.add(doc)
+            stats.append(dealer_stats)
+        return stats
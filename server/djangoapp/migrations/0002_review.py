@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djangoapp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Review',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('review_id', models.CharField(max_length=64, null=True, unique=True)),
+                ('dealership', models.IntegerField()),
+                ('name', models.CharField(max_length=100)),
+                ('purchase', models.BooleanField(default=False)),
+                ('review', models.TextField()),
+                ('purchase_date', models.DateField(null=True)),
+                ('car_make', models.CharField(max_length=50, null=True)),
+                ('car_model', models.CharField(max_length=100, null=True)),
+                ('car_year', models.IntegerField(null=True)),
+                ('sentiment', models.CharField(max_length=10, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['dealership', 'id'], name='djangoapp_r_dealers_2cd83e_idx'), models.Index(fields=['car_make', 'car_model'], name='djangoapp_r_car_mak_ff5bc9_idx'), models.Index(fields=['purchase_date'], name='djangoapp_r_purchas_218de5_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djangoapp', '0002_review'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DealerStats',
+            fields=[
+                ('dealership', models.IntegerField(primary_key=True, serialize=False)),
+                ('reviews', models.IntegerField(default=0)),
+                ('positive', models.IntegerField(default=0)),
+                ('neutral', models.IntegerField(default=0)),
+                ('negative', models.IntegerField(default=0)),
+                ('purchases', models.IntegerField(default=0)),
+                ('make_counts', models.JSONField(default=dict)),
+            ],
+        ),
+    ]
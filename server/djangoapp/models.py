@@ -1,4 +1,6 @@
-from django.db import models
+from datetime import date, datetime
+
+from django.db import models, transaction
 from django.utils.timezone import now
 
 
@@ -40,6 +42,119 @@ class CarModel(models.Model):
     def __str__(self):
         return "Name: "+self.name + "Built At:" + str(self.year) + "Model :" + self.car_model
 
+# A dealer review stored in the local database, a copy of the review docs of the Cloudant DB.
+# Dealer pages can read their reviews from it (settings.REVIEWS_SOURCE = 'database') with an
+# indexed query instead of a call to the get-review cloud function.
+class Review(models.Model):
+    review_id = models.CharField(null=True, unique=True, max_length=64)  # `_id` of the Cloudant doc
+    dealership = models.IntegerField()
+    name = models.CharField(max_length=100)
+    purchase = models.BooleanField(default=False)
+    review = models.TextField()
+    purchase_date = models.DateField(null=True)
+    car_make = models.CharField(null=True, max_length=50)
+    car_model = models.CharField(null=True, max_length=100)
+    car_year = models.IntegerField(null=True)
+    sentiment = models.CharField(null=True, max_length=10)
+
+    class Meta:
+        indexes = [
+            # A dealer's reviews in page order
+            models.Index(fields=["dealership", "id"]),
+            models.Index(fields=["car_make", "car_model"]),
+            models.Index(fields=["purchase_date"]),
+        ]
+
+    # Creates an (unsaved) review from a review doc of the Cloudant DB or of add_review
+    @classmethod
+    def from_doc(cls, doc):
+        get = doc.get
+        review_id = get("_id") or (str(doc["id"]) if get("id") is not None else None)
+        return cls(review_id=review_id, dealership=int(doc["dealership"]), name=doc["name"],
+                   purchase=bool(get("purchase")), review=doc["review"],
+                   purchase_date=parse_purchase_date(get("purchase_date")), car_make=get("car_make"),
+                   car_model=get("car_model"), car_year=get("car_year"), sentiment=get("sentiment") or None)
+
+    def to_dealer_review(self):
+        return DealerReview(self.dealership, self.doc_id(), self.name, self.purchase, self.review, self.car_make,
+                            self.car_model, self.car_year, self.formatted_purchase_date(), self.sentiment)
+
+    # The review as a Cloudant review doc
+    def to_doc(self):
+        return {"_id": self.doc_id(), "dealership": self.dealership, "name": self.name,
+                "purchase": self.purchase, "review": self.review, "purchase_date": self.formatted_purchase_date(),
+                "car_make": self.car_make, "car_model": self.car_model, "car_year": self.car_year,
+                "sentiment": self.sentiment}
+
+    # Reviews posted by add_review have no Cloudant id in the local table
+    def doc_id(self):
+        return self.review_id or "local-{}".format(self.id)
+
+    def formatted_purchase_date(self):
+        return self.purchase_date.strftime("%m/%d/%Y") if self.purchase_date else None
+
+    def __str__(self):
+        return "Reviewer: " + self.name + " Review: " + self.review
+
+
+# Review aggregates of a dealer, shown in the dealer list without reading any review.
+# Kept up to date by add_review (DealerStats.record) and rebuilt by manage.py rebuild_dealer_stats
+class DealerStats(models.Model):
+    SENTIMENTS = ("positive", "neutral", "negative")
+
+    dealership = models.IntegerField(primary_key=True)
+    reviews = models.IntegerField(default=0)
+    positive = models.IntegerField(default=0)
+    neutral = models.IntegerField(default=0)
+    negative = models.IntegerField(default=0)
+    purchases = models.IntegerField(default=0)
+    make_counts = models.JSONField(default=dict)  # reviews by car make
+
+    # Counts one more review (a review doc) in the aggregates
+    def add(self, doc):
+        self.reviews += 1
+        sentiment = doc.get("sentiment")
+        # Reviews that were never analyzed show as neutral, and count as such
+        sentiment = sentiment if sentiment in self.SENTIMENTS else "neutral"
+        setattr(self, sentiment, getattr(self, sentiment) + 1)
+        if doc.get("purchase"):
+            self.purchases += 1
+        if doc.get("car_make"):
+            self.make_counts[doc["car_make"]] = self.make_counts.get(doc["car_make"], 0) + 1
+
+    # Counts a newly posted review in its dealer's aggregates
+    @classmethod
+    def record(cls, doc):
+        with transaction.atomic():
+            stats, _ = cls.objects.select_for_update().get_or_create(dealership=int(doc["dealership"]))
+            stats.add(doc)
+            stats.save()
+
+    @property
+    def purchase_ratio(self):
+        return self.purchases / self.reviews if self.reviews else 0.0
+
+    def top_makes(self, count=3):
+        return sorted(self.make_counts, key=lambda make: (-self.make_counts[make], make))[:count]
+
+    def to_dict(self):
+        return {"reviews": self.reviews, "positive": self.positive, "neutral": self.neutral,
+                "negative": self.negative, "purchase_ratio": round(self.purchase_ratio, 3),
+                "top_makes": self.top_makes()}
+
+
+# Purchase dates are "07/11/2020" in the Cloudant data and ISO dates in reviews from add_review
+def parse_purchase_date(value):
+    if not value:
+        return None
+    if isinstance(value, date):
+        return value
+    try:
+        return datetime.strptime(value, "%m/%d/%Y").date()
+    except ValueError:
+        return datetime.fromisoformat(value).date()
+
+
 # <HINT> Create a Car Model model `class CarModel(models.Model):`:
 # - Many-To-One relationship to Car Make model (One Car Make has many Car Models, using ForeignKey field)
 # - Name
@@ -51,7 +166,10 @@ class CarModel(models.Model):
 
 
 # <HINT> Create a plain Python class `CarDealer` to hold dealer data
+# Slotted: a dealer has no per-object __dict__, and many of them are kept in the dealer catalog
 class CarDealer:
+    __slots__ = ("address", "city", "full_name", "id", "lat", "long", "short_name", "st", "zip")
+
     def __init__(self, address, city, full_name, id, lat, long, short_name, st, zip):
         self.address = address
         self.city = city
@@ -63,10 +181,53 @@ class CarDealer:
         self.st = st
         self.zip = zip
 
+    # Creates a dealer from a dealership doc of the Cloudant DB
+    @classmethod
+    def from_doc(cls, doc):
+        return cls(doc["address"], doc["city"], doc["full_name"], doc["id"], doc["lat"], doc["long"],
+                   doc["short_name"], doc["st"], doc["zip"])
+
+    # Creates a list of dealers from many dealership docs
+    @classmethod
+    def from_rows(cls, docs):
+        return [cls(doc["address"], doc["city"], doc["full_name"], doc["id"], doc["lat"], doc["long"],
+                    doc["short_name"], doc["st"], doc["zip"]) for doc in docs]
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
     def __str__(self):
         return "Dealer name: " + self.full_name
 
+
+class CarDealerColumns:
+    # A large list of dealers stored column by column: one list per field instead of one object
+    # per dealer. Indexing or iterating creates CarDealer objects on demand.
+    fields = CarDealer.__slots__
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    @classmethod
+    def from_rows(cls, docs):
+        docs = docs if isinstance(docs, list) else list(docs)
+        return cls({field: [doc[field] for doc in docs] for field in cls.fields})
+
+    def __len__(self):
+        return len(self.columns["id"])
+
+    def __getitem__(self, index):
+        return CarDealer(*(self.columns[field][index] for field in self.fields))
+
+    def __iter__(self):
+        for values in zip(*(self.columns[field] for field in self.fields)):
+            yield CarDealer(*values)
+
+
 class DealerReview:
+    __slots__ = ("car_make", "car_model", "car_year", "dealership", "id", "name", "purchase", "purchase_date",
+                 "review", "sentiment")
+
     def __init__(self, dealership, id, name, purchase, review, car_make=None, car_model=None, car_year=None, purchase_date=None, sentiment="neutral"):
         self.car_make = car_make
         self.car_model = car_model
@@ -79,6 +240,17 @@ class DealerReview:
         self.review = review  # The actual review text
         self.sentiment = sentiment  # Watson NLU sentiment analysis of review
 
+    # Creates a review from a review doc of the Cloudant DB
+    # The car and purchase date may be missing, the sentiment is None if it was never analyzed
+    @classmethod
+    def from_doc(cls, doc):
+        get = doc.get
+        return cls(doc["dealership"], doc["_id"], doc["name"], doc["purchase"], doc["review"], get("car_make"),
+                   get("car_model"), get("car_year"), get("purchase_date"), get("sentiment") or None)
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
     def __str__(self):
         return "Reviewer: " + self.name + " Review: " + self.review
 # <HINT> Create a plain Python class `DealerReview` to hold review data
@@ -1,181 +1,532 @@
 import requests
-import json
-import os
-from .models import CarDealer, DealerReview
-from requests.auth import HTTPBasicAuth
-from ibm_watson import NaturalLanguageUnderstandingV1
-from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
-from ibm_watson.natural_language_understanding_v1 import Features, SentimentOptions
+import httpx
+import threading
+import asyncio
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from .models import CarDealer, DealerReview, DealerStats, Review
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection
+from .breaker import CircuitOpenError, UpstreamUnavailable, get_breaker, get_fallback, save_fallback
+from .catalog import DealerIndex, get_catalog, invalidate_catalog
+from .decoders import decode
+from .httpclient import get_async_client, get_client
+from .instrumentation import count, span
+from .search import get_review_search_index
+from .sentiment import get_backfill_executor, get_sentiment_backend, get_sentiment_cache
+from .singleflight import SingleFlight, flight_key
+
+logger = logging.getLogger(__name__)
+
+# In-flight upstream calls, shared by identical concurrent requests of every thread and task
+upstream_flights = SingleFlight()
 
 
 # Create a `get_request` to make HTTP GET requests
-# e.g., response = requests.get(url, params=params, headers={'Content-Type': 'application/json'},
-#                                     auth=HTTPBasicAuth('apikey', api_key))
+# e.g., response = get_client().get(url, params=params, headers={'Content-Type': 'application/json'},
+#                                   auth=HTTPBasicAuth('apikey', api_key))
+# All requests go through the shared pooled client (see httpclient.py), so connections are kept alive.
+# Each endpoint has a circuit breaker (see breaker.py): while the endpoint fails, or its circuit is
+# open and calls fail fast, the last known good response of the same request is returned, and
+# UpstreamUnavailable is raised when there is none.
+# Identical concurrent requests (url and parameters) share one call and its result, see singleflight.py
 def get_request(url, **kwargs):
-    print(kwargs)
-    print("GET from {} ".format(url))
+    return upstream_flights.do(flight_key("GET", url, kwargs), lambda: _get_request(url, kwargs))
+
+
+def _get_request(url, kwargs):
+    logger.debug("GET from %s %s", url, kwargs)
+    breaker = get_breaker(url)
+    if not breaker.allow():
+        logger.info("Circuit of %s is open, serving the last known good response", breaker.name)
+        return serve_fallback(url, kwargs, get_fallback(url, kwargs))
     try:
-        # Call get method of requests library with URL and parameters
-        response = requests.get(url, headers={'Content-Type': 'application/json'},
-                                    params=kwargs)
-    except:
+        # Call get method of the pooled client with URL and parameters
+        with span("upstream_get"):
+            response = get_client().get(url, headers={'Content-Type': 'application/json'},
+                                        params=kwargs)
+        logger.debug("GET from %s with status %s", url, response.status_code)
+        count_retries(response)
+        # Parse the response bytes directly with the fastest decoder installed (see decoders.py)
+        with span("json_decode"):
+            json_data = decode_upstream_response(response.status_code, response.content)
+    except (requests.exceptions.RequestException, UpstreamError, ValueError):
         # If any error occurs
-        print("Network exception occurred")
-    status_code = response.status_code
-    print("With status {} ".format(status_code))
-    json_data = json.loads(response.text)
+        logger.warning("GET from %s failed, serving the last known good response", url, exc_info=True)
+        count("upstream_error")
+        breaker.record_failure()
+        return serve_fallback(url, kwargs, get_fallback(url, kwargs))
+    breaker.record_success()
+    save_fallback(url, kwargs, response.content)
     return json_data
 
+
+# Returns the last known good response of a failed GET, or raises UpstreamUnavailable without one
+def serve_fallback(url, kwargs, fallback):
+    if fallback is None:
+        count("upstream_unavailable")
+        raise UpstreamUnavailable("{} is unavailable and no previous response of {} was saved".format(url, kwargs))
+    count("upstream_fallback")
+    return fallback
+
+
+class UpstreamError(Exception):
+    # A 5xx response of the API gateway or a cloud function
+    pass
+
+
+# Counts the retries urllib3 made for a response of the pooled client (see httpclient.py)
+def count_retries(response):
+    retries = getattr(response.raw, "retries", None)
+    if retries is not None and retries.history:
+        count("upstream_retry", len(retries.history))
+
+
+# Decodes a GET response, server errors count as failures of the endpoint
+def decode_upstream_response(status_code, content):
+    if status_code >= 500:
+        raise UpstreamError("Status {}".format(status_code))
+    return decode(content)
+
+
 # Create a `post_request` to make HTTP POST requests
-# e.g., response = requests.post(url, params=kwargs, json=payload)
+# e.g., response = get_client().post(url, params=kwargs, json=payload)
+# A POST has no fallback: while the circuit of the endpoint is open it raises CircuitOpenError at once
 def post_request(url, json_payload, **kwargs):
-    print("POST to {url}")
+    logger.debug("POST to %s", url)
+    breaker = get_breaker(url)
+    if not breaker.allow():
+        raise CircuitOpenError("Circuit of {} is open".format(breaker.name))
     try:
-        response = requests.post(url, params=kwargs, json=json_payload)
-    except:
-        print("An error occurred while making POST request. ")
+        with span("upstream_post"):
+            response = get_client().post(url, params=kwargs, json=json_payload)
+    except requests.exceptions.RequestException:
+        logger.warning("POST to %s failed", url, exc_info=True)
+        count("upstream_error")
+        breaker.record_failure()
+        raise
     status_code = response.status_code
-    print("With status {status_code}")
+    logger.debug("POST to %s with status %s", url, status_code)
+    if status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return response
+
+
+# Async versions of get_request and post_request for the async views (see async_views.py)
+# While waiting on the upstream they leave the event loop free for other requests
+async def async_get_request(url, **kwargs):
+    return await upstream_flights.do_async(flight_key("GET", url, kwargs), lambda: _async_get_request(url, kwargs))
+
+
+async def _async_get_request(url, kwargs):
+    logger.debug("GET from %s %s", url, kwargs)
+    breaker = get_breaker(url)
+    if not breaker.allow():
+        logger.info("Circuit of %s is open, serving the last known good response", breaker.name)
+        return serve_fallback(url, kwargs, await sync_to_async(get_fallback)(url, kwargs))
+    try:
+        with span("upstream_get"):
+            response = await get_async_client().get(url, headers={'Content-Type': 'application/json'},
+                                                    params=kwargs)
+        logger.debug("GET from %s with status %s", url, response.status_code)
+        # Parse the response bytes directly with the fastest decoder installed (see decoders.py)
+        with span("json_decode"):
+            json_data = decode_upstream_response(response.status_code, response.content)
+    except (httpx.HTTPError, UpstreamError, ValueError):
+        logger.warning("GET from %s failed, serving the last known good response", url, exc_info=True)
+        count("upstream_error")
+        breaker.record_failure()
+        return serve_fallback(url, kwargs, await sync_to_async(get_fallback)(url, kwargs))
+    breaker.record_success()
+    await sync_to_async(save_fallback)(url, kwargs, response.content)
+    return json_data
 
+
+async def async_post_request(url, json_payload, **kwargs):
+    logger.debug("POST to %s", url)
+    breaker = get_breaker(url)
+    if not breaker.allow():
+        raise CircuitOpenError("Circuit of {} is open".format(breaker.name))
+    try:
+        with span("upstream_post"):
+            response = await get_async_client().post(url, params=kwargs, json=json_payload)
+    except httpx.HTTPError:
+        logger.warning("POST to %s failed", url, exc_info=True)
+        count("upstream_error")
+        breaker.record_failure()
+        raise
+    status_code = response.status_code
+    logger.debug("POST to %s with status %s", url, status_code)
+    if status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
     return response
 
+
+_fetch_executor = None
+_fetch_executor_lock = threading.Lock()
+
+
+def get_fetch_executor():
+    global _fetch_executor
+    if _fetch_executor is None:
+        with _fetch_executor_lock:
+            if _fetch_executor is None:
+                _fetch_executor = ThreadPoolExecutor(max_workers=getattr(settings, "FETCH_MAX_WORKERS", 16),
+                                                     thread_name_prefix="fetch")
+    return _fetch_executor
+
+
+# Runs the independent fetches a page needs at the same time, so it waits for the slowest one
+# instead of their sum. `remote` and `local` map names to functions without arguments:
+# remote ones (upstream calls) run on the shared fetch pool, local ones (ORM queries, which use
+# the database connection of the request thread) run in the calling thread meanwhile.
+# Remote functions run in a copy of the caller's context, so their timing spans count towards
+# the current request (see instrumentation.py).
+# Returns a dict of results and a dict of exceptions, both by name
+def fetch_concurrently(remote=None, local=None):
+    futures = {name: get_fetch_executor().submit(contextvars.copy_context().run, func)
+               for name, func in (remote or {}).items()}
+    results = {}
+    errors = {}
+    for name, func in (local or {}).items():
+        try:
+            results[name] = func()
+        except Exception as e:
+            errors[name] = e
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            errors[name] = e
+    return results, errors
+
+
+# Async version of fetch_concurrently, for awaitables (coroutines) by name
+async def async_fetch_concurrently(**awaitables):
+    values = await asyncio.gather(*awaitables.values(), return_exceptions=True)
+    results = {}
+    errors = {}
+    for name, value in zip(awaitables, values):
+        if isinstance(value, Exception):
+            errors[name] = value
+        else:
+            results[name] = value
+    return results, errors
+
 # Create a get_dealers_from_cf method to get dealers from a cloud function
 # def get_dealers_from_cf(url, **kwargs):
 # - Call get_request() with specified arguments
 # - Parse JSON results into a CarDealer object list
  # Gets all dealers from the Cloudant DB with the Cloud Function get-dealerships
 def get_dealers_from_cf(url):
-    results = []
     json_result = get_request(url)
     # Retrieve the dealer data from the response
     dealers = json_result["body"]["rows"]
-    # For each dealer in the response
-    for dealer in dealers:
-        # Get its data in `doc` object
-        dealer_doc = dealer["doc"]
-        # Create a CarDealer object with values in `doc` object
-        dealer_obj = CarDealer(address=dealer_doc["address"], city=dealer_doc["city"], full_name=dealer_doc["full_name"],
-                               id=dealer_doc["id"], lat=dealer_doc["lat"], long=dealer_doc["long"],
-                               short_name=dealer_doc["short_name"],
-                               st=dealer_doc["st"], zip=dealer_doc["zip"])
-        results.append(dealer_obj)
+    # Create a CarDealer object for the `doc` object of each dealer in the response
+    return CarDealer.from_rows(dealer["doc"] for dealer in dealers)
+
+
+# Gets all dealers of the url, indexed by id, state and zip (see catalog.py)
+# The index is built from one get_dealers_from_cf call and refreshed in the background
+def get_dealer_index(url):
+    return get_catalog(url, lambda previous: DealerIndex.build(get_dealers_from_cf(url), previous)).get()
+
+
+# Gets all dealers like get_dealers_from_cf, from the cached dealer index
+def get_cached_dealers(url):
+    return get_dealer_index(url).dealers
+
+
+# Gets the dealers of the url closest to lat/long as (dealer, distance in km) pairs, nearest first:
+# the k nearest ones, or every dealer within radius_km when a radius is given
+def get_dealers_near(url, lat, long, k=5, radius_km=None):
+    geo = get_dealer_index(url).geo
+    if radius_km is not None:
+        return geo.within(lat, long, radius_km)
+    return geo.nearest(lat, long, k)
+
+
+# Looks a dealer (or dealers) up in the index of settings.DEALERSHIPS_URL
+# Returns None if the index has no answer, or it can't be loaded
+def lookup_dealer_index(lookup):
+    try:
+        return lookup(get_dealer_index(settings.DEALERSHIPS_URL))
+    except Exception:
+        logger.warning("Dealer index is not available", exc_info=True)
+        return None
 
-    return results
+
+# Forgets the cached dealers of the url (or of every url), the next call fetches them again
+def invalidate_cached_dealers(url=None):
+    invalidate_catalog(url)
 
 
 # Gets a single dealer from the Cloudant DB with the Cloud Function get-dealerships
 # Requires the dealer_id parameter with only a single value
 def get_dealer_by_id(url, dealer_id):
+    # Answer from the dealer index when the dealer is in it
+    dealer_obj = lookup_dealer_index(lambda index: index.by_id.get(int(dealer_id)))
+    if dealer_obj is not None:
+        return dealer_obj
     # Call get_request with the dealer_id param
     json_result = get_request(url,dealer_id=dealer_id)
-    print(json_result)
-    # Create a CarDealer object from response
-    dealer = json_result["entries"]
-    dealer_obj = CarDealer(address=dealer["address"], city=dealer["city"], full_name=dealer["full_name"],
-                           id=dealer["id"], lat=dealer["lat"], long=dealer["long"],
-                           short_name=dealer["short_name"],
-                           st=dealer["st"], zip=dealer["zip"])
+    return parse_dealer_entry(json_result)
+
 
-    return dealer_obj
+# Async version of get_dealer_by_id
+async def async_get_dealer_by_id(url, dealer_id):
+    dealer_obj = await sync_to_async(lookup_dealer_index)(lambda index: index.by_id.get(int(dealer_id)))
+    if dealer_obj is not None:
+        return dealer_obj
+    json_result = await async_get_request(url, dealer_id=dealer_id)
+    return parse_dealer_entry(json_result)
+
+
+# Creates a CarDealer object from the response of the get-dealer cloud function
+def parse_dealer_entry(json_result):
+    # Create a CarDealer object from response
+    return CarDealer.from_doc(json_result["entries"])
 
 
 # Gets all dealers in the specified state from the Cloudant DB with the Cloud Function get-dealerships
 def get_dealers_by_state(url, state):
-    results = []
+    # Answer from the dealer index when it has dealers in the state
+    results = lookup_dealer_index(lambda index: index.by_state.get(state))
+    if results is not None:
+        return list(results)
     # Call get_request with the state param
     json_result = get_request(url, state=state)
     dealers = json_result["body"]["docs"]
-    # For each dealer in the response
-    for dealer in dealers:
-        # Create a CarDealer object with values in `doc` object
-        dealer_obj = CarDealer(address=dealer["address"], city=dealer["city"], full_name=dealer["full_name"],
-                               id=dealer["id"], lat=dealer["lat"], long=dealer["long"],
-                               short_name=dealer["short_name"],
-                               st=dealer["st"], zip=dealer["zip"])
-        results.append(dealer_obj)
-
-    return results
+    # Create a CarDealer object for each dealer in the response
+    return CarDealer.from_rows(dealers)
 
 # Create a get_dealer_reviews_from_cf method to get reviews by dealer id from a cloud function
 # def get_dealer_by_id_from_cf(url, dealerId):
 # - Call get_request() with specified arguments
 # - Parse JSON results into a DealerView object list
 def get_dealer_reviews_from_cf(url, dealer_id):
-    results = []
+    results, _ = get_dealer_reviews_page(url, dealer_id)
+    return results
+
+
+# Gets one page of a dealer's reviews: at most `limit` reviews (all of them without a limit),
+# starting at the `bookmark` returned with the previous page.
+# Returns the DealerReview list and the bookmark of the next page (None on the last page)
+# With settings.REVIEWS_SOURCE = 'database' the page is read from the Review table instead
+def get_dealer_reviews_page(url, dealer_id, limit=None, bookmark=None):
+    if settings.REVIEWS_SOURCE == "database":
+        return get_stored_dealer_reviews_page(dealer_id, limit, bookmark)
+    params = dealer_reviews_params(dealer_id, limit, bookmark)
+
     # Perform a GET request with the specified dealer id
-    json_result = get_request(url, dealerId=dealer_id)
-
-    if json_result:
-        # Get all review data from the response
-        reviews = json_result["body"]["data"]["docs"]
-        # For every review in the response
-        for review in reviews:
-            # Create a DealerReview object from the data
-            # These values must be present
-            review_content = review["review"]
-            id = review["_id"]
-            name = review["name"]
-            purchase = review["purchase"]
-            dealership = review["dealership"]
-
-            try:
-                # These values may be missing
-                car_make = review["car_make"]
-                car_model = review["car_model"]
-                car_year = review["car_year"]
-                purchase_date = review["purchase_date"]
-
-                # Creating a review object
-                review_obj = DealerReview(dealership=dealership, id=id, name=name, 
-                                          purchase=purchase, review=review_content, car_make=car_make, 
-                                          car_model=car_model, car_year=car_year, purchase_date=purchase_date
-                                          )
-
-            except KeyError:
-                print("Something is missing from this review. Using default values.")
-                # Creating a review object with some default values
-                review_obj = DealerReview(
-                    dealership=dealership, id=id, name=name, purchase=purchase, review=review_content)
-
-            # Analysing the sentiment of the review object's review text and saving it to the object attribute "sentiment"
-            review_obj.sentiment = analyze_review_sentiments(review_obj.review)
-            print(f"sentiment: {review_obj.sentiment}")
-
-            # Saving the review object to the list of results
-            results.append(review_obj)
+    # The parsing and sentiment pass of a page are shared by identical concurrent requests too
+    def fetch_page():
+        json_result = get_request(url, **params)
+        return parse_dealer_reviews_page(json_result, limit)
+    return upstream_flights.do(flight_key("reviews-page", url, params), fetch_page)
 
-    return results
+
+# Async version of get_dealer_reviews_page
+async def async_get_dealer_reviews_page(url, dealer_id, limit=None, bookmark=None):
+    if settings.REVIEWS_SOURCE == "database":
+        return await sync_to_async(get_stored_dealer_reviews_page)(dealer_id, limit, bookmark)
+    params = dealer_reviews_params(dealer_id, limit, bookmark)
+
+    async def fetch_page():
+        json_result = await async_get_request(url, **params)
+        return await sync_to_async(parse_dealer_reviews_page)(json_result, limit)
+    return await upstream_flights.do_async(flight_key("reviews-page", url, params), fetch_page)
+
+
+def dealer_reviews_params(dealer_id, limit=None, bookmark=None):
+    params = {"dealerId": dealer_id}
+    if limit:
+        params["limit"] = limit
+    if bookmark:
+        params["bookmark"] = bookmark
+    return params
+
+
+# Creates the DealerReview list and next bookmark of a page from the get-review cloud function response
+def parse_dealer_reviews_page(json_result, limit=None):
+    if not json_result:
+        return [], None
+
+    data = json_result["body"]["data"]
+    # An upstream that ignores the limit returns more docs, with a bookmark after the last one:
+    # they are all served, dropping some would skip them on the next page.
+    # A full page may be the last one, the upstream bookmark can't tell: its next page is empty
+    # and says there are no more reviews (see dealer_details.html)
+    results = list(parse_dealer_reviews(data["docs"]))
+
+    fill_review_sentiments(results)
+    index_reviews(results)
+    next_bookmark = data.get("bookmark") if limit and len(results) >= limit else None
+    return results, next_bookmark
+
+
+# Gets one page of a dealer's reviews from the Review table, like get_dealer_reviews_page
+# The bookmark is the primary key of the last review of the previous page, so each page is a
+# range scan of the (dealership, id) index
+def get_stored_dealer_reviews_page(dealer_id, limit=None, bookmark=None):
+    reviews = Review.objects.filter(dealership=dealer_id).order_by("id")
+    if bookmark:
+        try:
+            reviews = reviews.filter(id__gt=int(bookmark))
+        except ValueError:
+            pass
+    # One row more than the page tells whether there is a next page
+    rows = list(reviews[:limit + 1] if limit else reviews)
+    has_next = bool(limit) and len(rows) > limit
+    rows = rows[:limit] if limit else rows
+    results = [row.to_dealer_review() for row in rows]
+    fill_review_sentiments(results)
+    # The labels analyzed for rows without a sentiment are stored in them, after the backfill
+    # (the backfill worker runs its tasks in order)
+    unstored = {}
+    for row in rows:
+        if row.sentiment is None:
+            unstored.setdefault(row.review, []).append(row.pk)
+    if unstored:
+        get_backfill_executor().submit(store_review_sentiments, unstored)
+    index_reviews(results)
+    next_bookmark = str(rows[-1].id) if has_next else None
+    return results, next_bookmark
+
+
+# Stores the cached label of each review text in its Review rows, given as {text: [pk, ...]},
+# one UPDATE per label. Texts whose analysis failed (not cached) stay without a sentiment.
+def store_review_sentiments(review_ids):
+    cache = get_sentiment_cache()
+    ids_by_label = {}
+    for review_text, ids in review_ids.items():
+        label = cache.get(review_text)
+        if label is not None:
+            ids_by_label.setdefault(label, []).extend(ids)
+    try:
+        for label, ids in ids_by_label.items():
+            Review.objects.filter(pk__in=ids, sentiment=None).update(sentiment=label)
+    finally:
+        # Runs on the backfill worker, whose connection no request closes
+        connection.close()
+
+
+# Reviews posted before add_review computed the sentiment use the cached one,
+# the others are analyzed in the background
+def fill_review_sentiments(results):
+    unanalyzed = [review_obj for review_obj in results if review_obj.sentiment is None]
+    sentiments = get_review_sentiments_or_backfill([review_obj.review for review_obj in unanalyzed])
+    for review_obj, sentiment in zip(unanalyzed, sentiments):
+        review_obj.sentiment = sentiment
+
+
+# Keeps the local copies in step with the cloud function: a review posted by add_review is
+# counted in its dealer's DealerStats and added to the search index, and to the Review table
+# when dealer pages read their reviews from it.
+# The review is already posted when this runs, so a failure here is logged, not raised: the local
+# copies miss the review until they are rebuilt (manage.py rebuild_dealer_stats, bulkdata import)
+def store_review(review):
+    try:
+        DealerStats.record(review)
+        stored = Review.from_doc(review)
+        if settings.REVIEWS_SOURCE == "database":
+            stored.save()
+        index_reviews([stored.to_dealer_review()])
+    except Exception:
+        logger.exception("Storing the posted review of dealer %s failed", review.get("dealership"))
+
+
+# Adds DealerReview objects to the review search index, with the state of their dealer
+def index_reviews(reviews):
+    if not reviews:
+        return
+    dealers = lookup_dealer_index(lambda dealer_index: dealer_index.by_id) or {}
+    get_review_search_index().add([(review, getattr(dealers.get(review.dealership), "st", None))
+                                   for review in reviews])
+
+
+# Creates a DealerReview object for each review doc, one at a time
+# The sentiment is the one stored with the review, or None if it was never analyzed
+def parse_dealer_reviews(reviews):
+    # For every review in the response
+    for review in reviews:
+        # Create a DealerReview object from the data
+        yield DealerReview.from_doc(review)
 
 
 # Create an `analyze_review_sentiments` method to call Watson NLU and analyze text
 # def analyze_review_sentiments(text):
 # - Call get_request() with specified arguments
 # - Get the returned sentiment label such as Positive or Negative
+# The label comes from the configured sentiment backend (see sentiment.py), cached by review text
 def analyze_review_sentiments(review_text):
-    # Watson NLU configuration
-    api_key = "FKnMcCqfcmDYXci3s5QDOCEs2alVUWjt0EA1lb96q061"
-    url = "https://api.us-south.natural-language-understanding.watson.cloud.ibm.com/instances/9ff52216-d0c0-4586-aece-8b34ea1016d6"
-    version = '2021-08-01'
-    authenticator = IAMAuthenticator(api_key)
-    nlu = NaturalLanguageUnderstandingV1(
-        version=version, authenticator=authenticator)
-    nlu.set_service_url(url)
-
-    # get sentiment of the review
-    try:
-        response = nlu.analyze(text=review_text, features=Features(
-            sentiment=SentimentOptions())).get_result()
-        print(json.dumps(response))
-        # sentiment_score = str(response["sentiment"]["document"]["score"])
-        sentiment_label = response["sentiment"]["document"]["label"]
-    except:
-        print("Review is too short for sentiment analysis. Assigning default sentiment value 'neutral' instead")
-        sentiment_label = "neutral"
+    return analyze_review_sentiments_batch([review_text])[0]
+
 
-    # print(sentiment_score)
-    print(sentiment_label)
+# Analyzes a list of review texts and returns one label per text, in the same order
+# Identical texts are analyzed once and cached labels are used directly; only the remaining
+# texts go to the sentiment backend, in a single batch
+def analyze_review_sentiments_batch(review_texts):
+    cache = get_sentiment_cache()
+    labels = {}
+    missing = []
+    for review_text in review_texts:
+        if review_text in labels:
+            continue
+        labels[review_text] = cache.get(review_text)
+        if labels[review_text] is None:
+            missing.append(review_text)
+    count("sentiment_cache_hit", len(labels) - len(missing))
+    if missing:
+        count("sentiment_cache_miss", len(missing))
+        with span("sentiment"):
+            sentiments = get_sentiment_backend().analyze_batch(missing)
+        for review_text, sentiment_label in zip(missing, sentiments):
+            if sentiment_label is None:
+                # The backend could not analyze it right now, try again on the next request
+                logger.warning("Sentiment analysis failed. Assigning default sentiment value 'neutral' instead")
+                sentiment_label = "neutral"
+            else:
+                cache.set(review_text, sentiment_label)
+            labels[review_text] = sentiment_label
+    return [labels[review_text] for review_text in review_texts]
 
-    return sentiment_label
 
+_backfilling = set()
+_backfilling_lock = threading.Lock()
 
 
+# Returns the cached label of each text, or "neutral" for texts that were never analyzed.
+# Those texts are analyzed by the backfill worker, so the next request gets their real label.
+def get_review_sentiments_or_backfill(review_texts):
+    cache = get_sentiment_cache()
+    labels = [cache.get(review_text) for review_text in review_texts]
+    missing = [review_text for review_text, label in zip(review_texts, labels) if label is None]
+    count("sentiment_cache_hit", len(labels) - len(missing))
+    if missing:
+        count("sentiment_cache_miss", len(missing))
+        schedule_sentiment_backfill(missing)
+    return [label or "neutral" for label in labels]
+
+
+# Analyzes the texts on the backfill worker, skipping texts that are already scheduled
+def schedule_sentiment_backfill(review_texts):
+    with _backfilling_lock:
+        review_texts = [review_text for review_text in dict.fromkeys(review_texts) if review_text not in _backfilling]
+        _backfilling.update(review_texts)
+    if review_texts:
+        get_backfill_executor().submit(_backfill_sentiments, review_texts)
+
+
+def _backfill_sentiments(review_texts):
+    try:
+        analyze_review_sentiments_batch(review_texts)
+    finally:
+        with _backfilling_lock:
+            _backfilling.difference_update(review_texts)
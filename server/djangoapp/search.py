@@ -0,0 +1,135 @@
+import re
+import threading
+from array import array
+
+import numpy as np
+
+
+# Full-text and faceted search over the reviews the app has seen: the pages read from the
+# get-review cloud function (or the Review table) and the reviews posted by add_review.
+# An in-process index built incrementally as reviews come in:
+# - an inverted index from each word of the review text to the rows containing it
+# - one NumPy column per filter (dealer, state, make, model, year, sentiment) of value codes
+# so a search like index.search(make="Audi", model="A6", sentiment="negative", state="TX") is a
+# few vectorized comparisons, and its facet counts a bincount, instead of fetching and
+# filtering every dealer's reviews.
+
+WORD_RE = re.compile(r"\w+")
+
+# Result fields of a review, in the order they are stored
+FIELDS = ("dealership", "name", "review", "st", "make", "model", "year", "sentiment", "purchase", "purchase_date")
+# Filter name of search() -> coded column, the categorical ones match case-insensitively
+CATEGORICAL = {"state": "st", "make": "make", "model": "model", "year": "year", "sentiment": "sentiment"}
+FACETS = ("make", "year", "sentiment")
+
+
+class Column:
+    # A growable array of value codes, with the code of every distinct value (code 0 is None)
+    def __init__(self, fold=False):
+        self.codes = np.zeros(1024, dtype=np.int32)
+        self.values = [None]
+        self.by_value = {None: 0}
+        self.fold = fold
+
+    def _key(self, value):
+        return value.casefold() if self.fold and isinstance(value, str) else value
+
+    def code(self, value, add=False):
+        key = self._key(value)
+        code = self.by_value.get(key)
+        if code is None and add:
+            code = self.by_value[key] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def set(self, row, value):
+        if row >= len(self.codes):
+            self.codes = np.concatenate([self.codes, np.zeros(len(self.codes), dtype=np.int32)])
+        self.codes[row] = self.code(value, add=True)
+
+
+class ReviewSearchIndex:
+    def __init__(self):
+        self.rows = []          # field tuples, by row
+        self.by_key = {}        # (dealership, name, review) -> row
+        self.words = {}         # word -> array of the rows containing it, ascending
+        self.dealership = Column()
+        self.columns = {column: Column(fold=column != "sentiment") for column in CATEGORICAL.values()}
+        self.lock = threading.Lock()
+
+    # Adds or updates reviews, each a (DealerReview, state of its dealer) pair.
+    # A review is identified by its dealer, reviewer and text: the reviews posted by add_review
+    # have no Cloudant id yet, and are the same reviews when they come back from the cloud function
+    def add(self, reviews):
+        with self.lock:
+            for review, state in reviews:
+                fields = (review.dealership, review.name, review.review, state, review.car_make, review.car_model,
+                          review.car_year, review.sentiment, bool(review.purchase), review.purchase_date)
+                key = fields[:3]
+                row = self.by_key.get(key)
+                if row is None:
+                    row = self.by_key[key] = len(self.rows)
+                    self.rows.append(fields)
+                    # The text is part of the key, so a row's words never change
+                    for word in set(WORD_RE.findall(review.review.casefold())):
+                        self.words.setdefault(word, array("i")).append(row)
+                else:
+                    self.rows[row] = fields
+                self.dealership.set(row, review.dealership)
+                for column, value in zip(("st", "make", "model", "year", "sentiment"), fields[3:8]):
+                    self.columns[column].set(row, value)
+
+    # Returns the reviews (newest first) containing every word of `text` and matching the
+    # filters, e.g. search(make="Audi", sentiment="negative", state="TX"), as
+    # {"total": ..., "reviews": [...], "facets": {"make": {"Audi": 3, ...}, "year": ..., "sentiment": ...}}
+    # The facets count the reviews of the whole result, not only of the returned page
+    def search(self, text=None, limit=20, offset=0, dealership=None, **filters):
+        with self.lock:
+            size = len(self.rows)
+            matches = None
+            for word in WORD_RE.findall((text or "").casefold()):
+                rows = np.frombuffer(self.words.get(word, array("i")), dtype=np.int32)
+                matches = rows if matches is None else np.intersect1d(matches, rows, assume_unique=True)
+            mask = None
+            conditions = [(self.dealership, dealership)] + [(self.columns[CATEGORICAL[name]], value)
+                                                            for name, value in filters.items()]
+            for column, value in conditions:
+                if value is None or value == "":
+                    continue
+                code = column.code(value)
+                if code is None:
+                    matches = np.empty(0, dtype=np.int32)
+                    break
+                condition = column.codes[:size] == code
+                mask = condition if mask is None else mask & condition
+            if matches is None:
+                matches = np.flatnonzero(mask) if mask is not None else np.arange(size)
+            elif mask is not None and len(matches):
+                matches = matches[mask[matches]]
+
+            page = matches[::-1][offset:offset + limit]
+            reviews = [dict(zip(FIELDS, self.rows[row])) for row in page.tolist()]
+            facets = {}
+            for facet in FACETS:
+                column = self.columns[CATEGORICAL[facet]]
+                counts = np.bincount(column.codes[matches], minlength=len(column.values))
+                facets[facet] = {column.values[code]: int(counts[code])
+                                 for code in np.argsort(-counts, kind="stable") if counts[code]}
+        return {"total": len(matches), "reviews": reviews, "facets": facets}
+
+    def __len__(self):
+        return len(self.rows)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+# Returns the process-wide review search index
+def get_review_search_index():
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = ReviewSearchIndex()
+    return _index
@@ -0,0 +1,326 @@
+import hashlib
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from ibm_cloud_sdk_core import ApiException
+from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
+from ibm_watson import NaturalLanguageUnderstandingV1
+from ibm_watson.natural_language_understanding_v1 import Features, SentimentOptions
+
+logger = logging.getLogger(__name__)
+
+
+# Default configuration of the sentiment cache, overridden by settings.SENTIMENT_CACHE
+CACHE_DEFAULTS = {
+    "MAX_SIZE": 4096,   # entries kept in process memory (least recently used are evicted)
+    "TTL": 86400,       # seconds before a label is analyzed again
+    "BACKEND": None,    # optional Django cache alias shared by all workers, e.g. "default"
+}
+
+
+class SentimentCache:
+    # Caches sentiment labels by a hash of the review text.
+    # Lookups go to the in-process LRU first and then to the shared Django cache backend (if any),
+    # so a review text is only sent to NLU once per TTL.
+    def __init__(self, max_size=4096, ttl=86400, backend=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.backend = caches[backend] if backend else None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(text):
+        return "sentiment:" + hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, text):
+        key = self.key(text)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                label, expires = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return label
+                del self._entries[key]
+        label = self.backend.get(key) if self.backend is not None else None
+        with self._lock:
+            if label is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._store(key, label, now)
+        return label
+
+    def set(self, text, label):
+        key = self.key(text)
+        with self._lock:
+            self._store(key, label, time.monotonic())
+        if self.backend is not None:
+            self.backend.set(key, label, self.ttl)
+
+    def _store(self, key, label, now):
+        self._entries[key] = (label, now + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+# Returns the process-wide sentiment cache, created on first use from settings.SENTIMENT_CACHE
+def get_sentiment_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                config = dict(CACHE_DEFAULTS, **getattr(settings, "SENTIMENT_CACHE", {}))
+                _cache = SentimentCache(max_size=config["MAX_SIZE"], ttl=config["TTL"],
+                                        backend=config["BACKEND"])
+    return _cache
+
+
+class SentimentService:
+    # Wraps one Watson NLU client for the whole process.
+    # The client (and its IAM authenticator) is built on first use; the authenticator keeps the
+    # bearer token and only exchanges the api key for a new one when the token is about to expire.
+    def __init__(self, api_key, url, version, iam_url=None, timeout=None):
+        self.api_key = api_key
+        self.url = url
+        self.version = version
+        self.iam_url = iam_url
+        self.timeout = timeout
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    authenticator = IAMAuthenticator(self.api_key, url=self.iam_url)
+                    nlu = NaturalLanguageUnderstandingV1(version=self.version, authenticator=authenticator)
+                    nlu.set_service_url(self.url)
+                    if self.timeout:
+                        # A slow analysis raises instead of holding up the page
+                        nlu.set_http_config({"timeout": self.timeout})
+                    self._client = nlu
+        return self._client
+
+    # Returns the raw NLU result for the text, raises ApiException when NLU refuses it
+    def analyze(self, text):
+        return self.client.analyze(text=text, features=Features(sentiment=SentimentOptions())).get_result()
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+# Returns the process-wide NLU service, configured from the NLU_* settings
+def get_sentiment_service():
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                _service = SentimentService(api_key=settings.NLU_API_KEY, url=settings.NLU_URL,
+                                            version=settings.NLU_VERSION,
+                                            iam_url=getattr(settings, "NLU_IAM_URL", None),
+                                            timeout=getattr(settings, "NLU_TIMEOUT", None))
+    return _service
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+# Returns the process-wide pool used to analyze reviews concurrently.
+# Its size (settings.SENTIMENT_MAX_WORKERS) caps the NLU requests in flight for the whole process.
+def get_sentiment_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=getattr(settings, "SENTIMENT_MAX_WORKERS", 8),
+                                               thread_name_prefix="sentiment")
+    return _executor
+
+
+_backfill_executor = None
+
+
+# Returns the single background worker that analyzes reviews stored without a sentiment.
+# It is separate from the sentiment pool because a backfill task waits on that pool.
+def get_backfill_executor():
+    global _backfill_executor
+    if _backfill_executor is None:
+        with _executor_lock:
+            if _backfill_executor is None:
+                _backfill_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sentiment-backfill")
+    return _backfill_executor
+
+
+# Sentiment backends
+# Every backend has `analyze_batch(texts)` returning one label per text ("positive", "negative" or
+# "neutral"), or None where the analysis failed for a reason that may go away (the caller then
+# uses "neutral" without caching it). settings.SENTIMENT_BACKEND picks the backend of the process.
+
+class RemoteSentimentBackend:
+    # Watson NLU, one document per call, several calls in flight on the sentiment pool
+    def __init__(self, service, executor):
+        self.service = service
+        self.executor = executor
+
+    def analyze(self, text):
+        try:
+            response = self.service.analyze(text)
+            return response["sentiment"]["document"]["label"]
+        except ApiException as e:
+            logger.debug("NLU refused review text (%s): %s", e.code, e.message)
+            # NLU rejected the text itself (e.g. too short), asking again would give the same answer
+            if 400 <= e.code < 500 and e.code not in (401, 403, 429):
+                return "neutral"
+        except Exception:
+            logger.exception("Sentiment analysis with NLU failed")
+        return None
+
+    def analyze_batch(self, texts):
+        if len(texts) <= 1:
+            return [self.analyze(text) for text in texts]
+        return list(self.executor.map(self.analyze, texts))
+
+
+# Word polarities used by the local engine, from -1 (very negative) to 1 (very positive)
+LEXICON = {
+    "amazing": 1.0, "awesome": 1.0, "excellent": 1.0, "fantastic": 1.0, "outstanding": 1.0,
+    "perfect": 1.0, "superb": 1.0, "wonderful": 1.0, "best": 0.9, "love": 0.9, "loved": 0.9,
+    "great": 0.8, "happy": 0.8, "recommend": 0.8, "recommended": 0.8, "impressive": 0.8,
+    "reliable": 0.7, "friendly": 0.7, "helpful": 0.7, "pleasant": 0.7, "professional": 0.6,
+    "good": 0.6, "nice": 0.6, "satisfied": 0.6, "smooth": 0.6, "efficient": 0.5, "easy": 0.5,
+    "fair": 0.4, "fast": 0.4, "quick": 0.4, "clean": 0.4, "honest": 0.6, "responsive": 0.4,
+    "comfortable": 0.5, "affordable": 0.5, "worth": 0.5, "thanks": 0.4, "like": 0.3,
+    "cohesive": 0.3, "success": 0.6, "intuitive": 0.5, "innovative": 0.5, "robust": 0.4,
+    "terrible": -1.0, "horrible": -1.0, "awful": -1.0, "worst": -1.0, "scam": -1.0,
+    "hate": -0.9, "hated": -0.9, "disgusting": -0.9, "useless": -0.8, "rude": -0.8,
+    "bad": -0.7, "poor": -0.7, "broken": -0.7, "disappointed": -0.7, "disappointing": -0.7,
+    "unreliable": -0.7, "dishonest": -0.8, "overpriced": -0.6, "expensive": -0.4, "slow": -0.5,
+    "problem": -0.5, "problems": -0.5, "issue": -0.4, "issues": -0.4, "dirty": -0.5,
+    "avoid": -0.7, "never": -0.3, "late": -0.4, "unhelpful": -0.7, "waste": -0.7, "wait": -0.2,
+    "difficult": -0.4, "noisy": -0.4, "unfortunately": -0.5, "complaint": -0.6, "failed": -0.6,
+}
+NEGATORS = {"not", "no", "never", "isn't", "wasn't", "don't", "didn't", "doesn't", "won't", "can't"}
+TOKEN_RE = re.compile(r"[a-z]+(?:'[a-z]+)?")
+
+
+class LocalSentimentBackend:
+    # Lexicon based engine that needs no network.
+    # A batch is scored with a few NumPy operations over the concatenated tokens of all texts:
+    # token polarities are summed per text (flipped after a negator) and squashed into (-1, 1).
+    def __init__(self, lexicon=None, threshold=0.1):
+        lexicon = LEXICON if lexicon is None else lexicon
+        words = sorted(set(lexicon) | NEGATORS)
+        # Index 0 stands for every word that is not in the lexicon
+        self.vocabulary = {word: index for index, word in enumerate(words, start=1)}
+        self.polarity = np.zeros(len(words) + 1)
+        self.negator = np.zeros(len(words) + 1, dtype=bool)
+        for word, index in self.vocabulary.items():
+            self.polarity[index] = lexicon.get(word, 0.0)
+            self.negator[index] = word in NEGATORS
+        self.threshold = threshold
+
+    # Returns the scores in (-1, 1) of the texts, their absolute value is the confidence
+    def score_batch(self, texts):
+        vocabulary = self.vocabulary
+        tokens = [[vocabulary.get(token, 0) for token in TOKEN_RE.findall(text.lower())] for text in texts]
+        lengths = np.fromiter((len(text_tokens) for text_tokens in tokens), dtype=np.intp, count=len(texts))
+        ids = np.fromiter((token for text_tokens in tokens for token in text_tokens), dtype=np.intp,
+                          count=int(lengths.sum()))
+        owner = np.repeat(np.arange(len(texts)), lengths)
+        weights = self.polarity[ids]
+        # A word right after a negator of the same text has its polarity flipped ("not good")
+        negated = np.zeros(len(ids), dtype=bool)
+        negated[1:] = self.negator[ids[:-1]] & (owner[1:] == owner[:-1])
+        weights = np.where(negated, -weights, weights)
+        totals = np.bincount(owner, weights=weights, minlength=len(texts))
+        return np.tanh(totals / np.sqrt(np.maximum(lengths, 1)) * 2)
+
+    def labels(self, scores):
+        return np.where(scores >= self.threshold, "positive",
+                        np.where(scores <= -self.threshold, "negative", "neutral")).tolist()
+
+    def analyze_batch(self, texts):
+        if not texts:
+            return []
+        return self.labels(self.score_batch(texts))
+
+
+class LocalFirstSentimentBackend:
+    # Scores everything locally and only asks the remote backend about texts the local engine
+    # is not confident about
+    def __init__(self, local, remote, min_confidence=0.3):
+        self.local = local
+        self.remote = remote
+        self.min_confidence = min_confidence
+
+    def analyze_batch(self, texts):
+        if not texts:
+            return []
+        scores = self.local.score_batch(texts)
+        labels = self.local.labels(scores)
+        unsure = np.flatnonzero(np.abs(scores) < self.min_confidence).tolist()
+        if unsure:
+            remote_labels = self.remote.analyze_batch([texts[index] for index in unsure])
+            for index, label in zip(unsure, remote_labels):
+                # Keep the local label when NLU is not reachable
+                if label is not None:
+                    labels[index] = label
+        return labels
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+# Returns the backend named by settings.SENTIMENT_BACKEND: "remote" (Watson NLU), "local",
+# or "local-first" (local engine, NLU for low confidence texts)
+def get_sentiment_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                name = getattr(settings, "SENTIMENT_BACKEND", "remote")
+                if name == "remote":
+                    _backend = RemoteSentimentBackend(get_sentiment_service(), get_sentiment_executor())
+                elif name == "local":
+                    _backend = LocalSentimentBackend()
+                elif name == "local-first":
+                    _backend = LocalFirstSentimentBackend(
+                        LocalSentimentBackend(),
+                        RemoteSentimentBackend(get_sentiment_service(), get_sentiment_executor()),
+                        min_confidence=getattr(settings, "SENTIMENT_LOCAL_MIN_CONFIDENCE", 0.3))
+                else:
+                    raise ImproperlyConfigured("Unknown SENTIMENT_BACKEND {!r}".format(name))
+    return _backend
@@ -0,0 +1,66 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+# Request coalescing: while a call for a key is in flight, identical calls (same key) wait for
+# it and get its result (or exception) instead of making their own. Threads and asyncio tasks
+# share the same in-flight calls, whichever started it, so under a spike of requests for one
+# dealer page the upstream sees one fetch per distinct key instead of one per request.
+# The result is shared by every waiter and must not be modified by them.
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.calls = 0      # calls made
+        self.shared = 0     # calls that waited for another one's result instead
+
+    def _join(self, key):
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.shared += 1
+                return future, False
+            future = self._calls[key] = Future()
+            self.calls += 1
+            return future, True
+
+    def _finish(self, key, future, result=None, exception=None):
+        with self._lock:
+            del self._calls[key]
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    # Returns func(), or the result of the identical call in flight
+    def do(self, key, func):
+        future, leader = self._join(key)
+        if not leader:
+            return future.result()
+        try:
+            result = func()
+        except BaseException as e:
+            self._finish(key, future, exception=e)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    # Async version of do, for a function returning an awaitable
+    async def do_async(self, key, func):
+        future, leader = self._join(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            result = await func()
+        except BaseException as e:
+            # Also a cancelled leader: its waiters get the CancelledError and may retry
+            self._finish(key, future, exception=e)
+            raise
+        self._finish(key, future, result)
+        return result
+
+
+# A hashable key of a call's url and parameters
+def flight_key(kind, url, params):
+    return kind, url, tuple(sorted((name, str(value)) for name, value in params.items()))
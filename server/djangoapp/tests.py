@@ -1,3 +1,920 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import importlib
+import io
+import itertools
+import random
+import json
+import jwt
+import numpy as np
+import requests
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import DatabaseError
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import clear_url_caches, resolve
+
+from .admin import CarMakeAdmin, CarModelAdmin
+from . import async_views, restapis
+from . import urls as djangoapp_urls
+from .breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, UpstreamUnavailable, get_breaker, reset_breakers
+from .cars import VERSION_KEY, get_car_choices
+from .catalog import CachedCatalog, DealerIndex
+from .dataservice import DataStore, Faults, start_server
+from .decoders import iter_json_array, iter_json_lines
+from .geo import GeoIndex, haversine_km
+from .httpclient import AsyncHttpClient, HttpClient
+from .instrumentation import metrics, set_enabled
+from .models import CarDealer, CarMake, CarModel, DealerReview, DealerStats, Review
+from .search import ReviewSearchIndex
+from .sentiment import (LocalFirstSentimentBackend, LocalSentimentBackend, SentimentCache, get_sentiment_cache,
+                        get_sentiment_service)
+
 
 # Create your tests here.
+
+# The caches of settings.CACHES, with the shared one in a directory of its own
+TEST_CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "shared": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": tempfile.mkdtemp()},
+}
+
+
+@override_settings(ALLOWED_HOSTS=["testserver"], CACHES=TEST_CACHES)
+class AddReviewCarsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.audi = CarMake.objects.create(name="Audi", description="German")
+        cls.mazda = CarMake.objects.create(name="Mazda", description="Japanese")
+        cls.a6 = CarModel.objects.create(car_make=cls.audi, name="A6", dealer_id=15, year=datetime.date(2010, 1, 1))
+        CarModel.objects.create(car_make=cls.mazda, name="MX-5", dealer_id=15, year=datetime.date(2003, 1, 1))
+        CarModel.objects.create(car_make=cls.mazda, name="CX-5", dealer_id=16, year=datetime.date(2018, 1, 1))
+        cls.user = User.objects.create_user("reviewer", password="password", first_name="Ada", last_name="Lee")
+        cls.dealer = CarDealer("3 Nova Court", "El Paso", "Holdlamis Car Dealership", 15, 31.6948, -106.3,
+                               "Holdlamis", "TX", "88563")
+
+    def setUp(self):
+        caches["shared"].clear()
+
+    def test_car_choices_are_one_query_then_cached(self):
+        with self.assertNumQueries(1):
+            choices = get_car_choices(15)
+        self.assertEqual([(car.make, car.name) for car in choices], [("Audi", "A6"), ("Mazda", "MX-5")])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_car_choices(15), choices)
+
+    def test_admin_saves_invalidate_car_choices(self):
+        get_car_choices(15)
+        self.audi.name = "Audi AG"
+        CarMakeAdmin(CarMake, admin.site).save_model(None, self.audi, None, True)
+        self.assertEqual(get_car_choices(15)[0].make, "Audi AG")
+        self.a6.name = "A4"
+        CarModelAdmin(CarModel, admin.site).save_model(None, self.a6, None, True)
+        self.assertEqual(get_car_choices(15)[0].name, "A4")
+
+    def test_admin_saves_invalidate_the_cars_of_every_worker(self):
+        # The cache of another worker process, reading the same files
+        other_worker = caches.create_connection("shared")
+        get_car_choices(15)
+        version = other_worker.get(VERSION_KEY)
+        CarMakeAdmin(CarMake, admin.site).save_model(None, self.audi, None, True)
+        self.assertEqual(other_worker.get(VERSION_KEY), version + 1)
+
+    def test_add_review_page_queries(self):
+        self.client.force_login(self.user)
+        with mock.patch("djangoapp.views.get_dealer_by_id", return_value=self.dealer):
+            # Session, user and one joined query for the cars
+            with self.assertNumQueries(3):
+                response = self.client.get("/djangoapp/dealer/15/add-review/")
+            self.assertContains(response, "Audi A6")
+            self.assertNotContains(response, "CX-5")
+            with self.assertNumQueries(2):
+                self.client.get("/djangoapp/dealer/15/add-review/")
+
+    def test_server_timing_and_metrics(self):
+        self.client.force_login(self.user)
+        self.addCleanup(set_enabled, False)
+        with mock.patch("djangoapp.views.get_dealer_by_id", return_value=self.dealer):
+            response = self.client.get("/djangoapp/dealer/15/add-review/")
+            self.assertNotIn("Server-Timing", response)
+            self.assertEqual(self.client.get("/djangoapp/metrics/").status_code, 404)
+            set_enabled(True)
+            metrics.reset()
+            response = self.client.get("/djangoapp/dealer/15/add-review/")
+        self.assertRegex(response["Server-Timing"], r'^render;dur=[\d.]+;desc="1 call", total;dur=[\d.]+$')
+        snapshot = self.client.get("/djangoapp/metrics/").json()
+        self.assertEqual(snapshot["counters"]["car_choices_cache_hit"], 1)
+        self.assertEqual(snapshot["spans"]["render"]["count"], 1)
+        self.assertEqual(snapshot["spans"]["request"]["count"], 1)
+
+    def test_post_review_queries(self):
+        self.client.force_login(self.user)
+        with mock.patch("djangoapp.views.post_request", return_value=mock.Mock(status_code=200)) as post_request, \
+                mock.patch("djangoapp.views.analyze_review_sentiments", return_value="positive"), \
+                mock.patch("djangoapp.views.store_review"):
+            # Session, user and one query for the car with its make
+            with self.assertNumQueries(3):
+                self.client.post("/djangoapp/dealer/15/add-review/", {"content": "Great car", "car": self.a6.id})
+        review = post_request.call_args.args[1]["review"]
+        self.assertEqual((review["car_make"], review["car_model"], review["car_year"]), ("Audi", "A6", 2010))
+
+
+@override_settings(ALLOWED_HOSTS=["testserver"])
+class DealerStatsTests(TestCase):
+    def test_record_counts_posted_reviews(self):
+        DealerStats.record({"dealership": 15, "sentiment": "positive", "purchase": "on", "car_make": "Audi"})
+        DealerStats.record({"dealership": 15, "sentiment": None, "purchase": None, "car_make": "Mazda"})
+        DealerStats.record({"dealership": 15, "sentiment": "negative", "purchase": None, "car_make": "Audi"})
+        self.assertEqual(DealerStats.objects.get(pk=15).to_dict(), {
+            "reviews": 3, "positive": 1, "neutral": 1, "negative": 1, "purchase_ratio": 0.333,
+            "top_makes": ["Audi", "Mazda"]})
+
+    def test_store_review_logs_database_errors(self):
+        review = {"dealership": 15, "name": "Ada Lee", "review": "Great car", "purchase": False}
+        with mock.patch("djangoapp.models.DealerStats.record", side_effect=DatabaseError("no such table")), \
+                self.assertLogs("djangoapp.restapis", "ERROR"):
+            restapis.store_review(review)
+
+    def test_dealer_list_rejects_filters_that_are_not_objects(self):
+        with mock.patch("djangoapp.views.get_dealer_index", return_value=DealerIndex.build([])):
+            for bad_filter in ("[1]", '"TX"', "null", "{"):
+                response = self.client.get("/djangoapp/", {"format": "json", "filter": bad_filter})
+                self.assertEqual(response.status_code, 400, bad_filter)
+
+    def test_dealer_list_reads_stats_in_one_query(self):
+        dealers = [CarDealer("{} Main Street".format(i), "Austin", "Dealer {}".format(i), i, 30.0, -97.0,
+                             "D{}".format(i), "TX", "73301") for i in range(1, 6)]
+        DealerStats.objects.create(dealership=2, reviews=4, positive=2, neutral=1, negative=1, purchases=1,
+                                   make_counts={"Audi": 4})
+        with mock.patch("djangoapp.views.get_dealer_index", return_value=DealerIndex.build(dealers)), \
+                self.assertNumQueries(1):
+            response = self.client.get("/djangoapp/?format=json")
+        rows = response.json()["rows"]
+        self.assertEqual(rows[1]["stats"]["reviews"], 4)
+        self.assertIsNone(rows[0]["stats"])
+
+
+class CircuitBreakerTests(TestCase):
+    def test_opens_fails_fast_and_recovers(self):
+        breaker = CircuitBreaker("upstream", failure_threshold=2, reset_timeout=0.05)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CLOSED)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, OPEN)
+        self.assertFalse(breaker.allow())
+        time.sleep(0.06)
+        self.assertEqual(breaker.state, HALF_OPEN)
+        # One trial call at a time, its failure opens the circuit again
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, OPEN)
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CLOSED)
+
+
+# Runs a seeded data service on a free port for the duration of a test case
+class DataServiceMixin:
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.store = DataStore()
+        cls.store.seed()
+        cls.faults = Faults()
+        cls.server = start_server(cls.store, faults=cls.faults)
+        # Clients that time out hang up on the server on purpose
+        cls.server.handle_error = lambda request, client_address: None
+        cls.base = "http://127.0.0.1:{}/api".format(cls.server.server_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.faults.error_rate = 0
+        test_caches = override_settings(CACHES=TEST_CACHES)
+        test_caches.enable()
+        self.addCleanup(test_caches.disable)
+        caches["default"].clear()
+        caches["shared"].clear()
+        reset_breakers()
+        restapis.invalidate_cached_dealers()
+        self.addCleanup(reset_breakers)
+        self.addCleanup(restapis.invalidate_cached_dealers)
+
+
+class HttpClientTests(DataServiceMixin, SimpleTestCase):
+    def test_connections_are_reused(self):
+        client = HttpClient()
+        # The server handles each accepted connection with one process_request call
+        with mock.patch.object(self.server, "process_request", wraps=self.server.process_request) as accepted:
+            for _ in range(5):
+                self.assertEqual(client.get(self.base + "/dealership", params={"state": "TX"}).status_code, 200)
+        self.assertEqual(accepted.call_count, 1)
+
+    def test_gets_time_out(self):
+        self.faults.hang = 0.3
+        self.addCleanup(setattr, self.faults, "hang", 0)
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            HttpClient({"READ_TIMEOUT": 0.05, "RETRIES": 0}).get(self.base + "/dealership")
+
+    def test_gets_are_retried(self):
+        self.faults.error_rate = 1
+        response = HttpClient({"RETRIES": 2, "BACKOFF_FACTOR": 0}).get(self.base + "/dealership")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(len(response.raw.retries.history), 2)
+        # A POST is never sent twice
+        response = HttpClient({"RETRIES": 2, "BACKOFF_FACTOR": 0}).post(self.base + "/review", json={})
+        self.assertEqual(response.raw.retries.history, ())
+
+    async def test_async_gets_are_retried(self):
+        self.faults.error_rate = 1
+        set_enabled(True)
+        self.addCleanup(set_enabled, False)
+        metrics.reset()
+        response = await AsyncHttpClient({"RETRIES": 2, "BACKOFF_FACTOR": 0}).get(self.base + "/dealership")
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(metrics.snapshot()["counters"]["upstream_retry"], 2)
+
+
+class SingleFlightTests(SimpleTestCase):
+    def test_threads_and_tasks_share_one_upstream_call(self):
+        # Each answer takes 0.3 s, so every caller below starts while the first call is in flight
+        store = DataStore()
+        store.seed()
+        server = start_server(store, delay=0.3)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = "http://127.0.0.1:{}/api/dealership".format(server.server_port)
+        caches["default"].clear()
+        reset_breakers()
+        results = []
+
+        async def tasks():
+            return await asyncio.gather(*(restapis.async_get_request(url, state="TX") for _ in range(10)))
+
+        with mock.patch("djangoapp.restapis._get_request", wraps=restapis._get_request) as sync_calls, \
+                mock.patch("djangoapp.restapis._async_get_request", wraps=restapis._async_get_request) as async_calls:
+            threads = [threading.Thread(target=lambda: results.append(restapis.get_request(url, state="TX")))
+                       for _ in range(10)]
+            for thread in threads:
+                thread.start()
+            results.extend(asyncio.run(tasks()))
+            for thread in threads:
+                thread.join()
+        self.assertEqual(sync_calls.call_count + async_calls.call_count, 1)
+        self.assertEqual(len(results), 20)
+        self.assertTrue(all(result is results[0] for result in results))
+        self.assertTrue(results[0]["body"]["docs"])
+
+
+@override_settings(ALLOWED_HOSTS=["testserver"])
+class PostReviewFailureTests(DataServiceMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        make = CarMake.objects.create(name="Audi", description="German")
+        cls.car = CarModel.objects.create(car_make=make, name="A6", dealer_id=15, year=datetime.date(2010, 1, 1))
+        cls.user = User.objects.create_user("reviewer", password="password", first_name="Ada", last_name="Lee")
+
+    def post_review(self, url):
+        self.client.force_login(self.user)
+        with override_settings(REVIEWS_URL=url), \
+                mock.patch("djangoapp.views.analyze_review_sentiments", return_value="positive"), \
+                mock.patch("djangoapp.views.store_review") as store_review, \
+                self.assertLogs("djangoapp", "WARNING"):
+            response = self.client.post("/djangoapp/dealer/15/add-review/",
+                                        {"content": "Great car", "car": self.car.id})
+        self.assertFalse(store_review.called)
+        return response
+
+    def test_failed_posts_are_unavailable(self):
+        # The upstream answers 503
+        self.faults.error_rate = 1
+        self.assertContains(self.post_review(self.base + "/review"), "could not be posted", status_code=503)
+        # Nothing listens on the port
+        self.assertContains(self.post_review("http://127.0.0.1:9/api/review"), "could not be posted",
+                            status_code=503)
+
+    def test_posts_fail_fast_while_the_circuit_is_open(self):
+        url = self.base + "/review"
+        get_breaker(url).opened_at = time.monotonic()
+        self.client.force_login(self.user)
+        with override_settings(REVIEWS_URL=url), \
+                mock.patch("djangoapp.views.analyze_review_sentiments", return_value="positive"), \
+                mock.patch("djangoapp.views.post_request", wraps=restapis.post_request):
+            response = self.client.post("/djangoapp/dealer/15/add-review/",
+                                        {"content": "Great car", "car": self.car.id})
+        self.assertContains(response, "could not be posted", status_code=503)
+
+
+@override_settings(ALLOWED_HOSTS=["testserver"])
+class UpstreamFallbackTests(DataServiceMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch("djangoapp.restapis.get_client", return_value=HttpClient({"RETRIES": 0}))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_failing_get_without_fallback_is_unavailable(self):
+        self.faults.error_rate = 1
+        with self.assertLogs("djangoapp.restapis", "WARNING"):
+            with self.assertRaises(UpstreamUnavailable):
+                restapis.get_request(self.base + "/dealership")
+            with override_settings(DEALERSHIPS_URL=self.base + "/dealership", DEALER_URL=self.base + "/dealer",
+                                   REVIEWS_URL=self.base + "/review"):
+                self.assertEqual(self.client.get("/djangoapp/?format=json").status_code, 503)
+                self.assertEqual(self.client.get("/djangoapp/dealers/near/?lat=31.7&long=-106.3").status_code, 503)
+                self.assertContains(self.client.get("/djangoapp/"), "unavailable", status_code=503)
+                self.assertContains(self.client.get("/djangoapp/dealer/15/"), "reviews are unavailable",
+                                    status_code=503)
+
+    def test_failing_get_serves_the_last_known_good_response(self):
+        url = self.base + "/dealership"
+        json_result = restapis.get_request(url, state="TX")
+        self.assertTrue(json_result["body"]["docs"])
+        self.faults.error_rate = 1
+        with self.assertLogs("djangoapp.restapis", "WARNING"):
+            self.assertEqual(restapis.get_request(url, state="TX"), json_result)
+            with self.assertRaises(UpstreamUnavailable):
+                restapis.get_request(url, state="CA")
+
+
+    def test_unchanged_responses_are_not_saved_again(self):
+        url = self.base + "/dealership"
+        shared = caches["shared"]
+        with mock.patch.object(shared, "set", wraps=shared.set) as saved:
+            for _ in range(3):
+                restapis.get_request(url, state="TX")
+            self.assertEqual(saved.call_count, 1)
+            self.assertIsInstance(saved.call_args[0][1], bytes)
+            with override_settings(UPSTREAM_BREAKER=dict(settings.UPSTREAM_BREAKER, FALLBACK_RESAVE=0)):
+                restapis.get_request(url, state="TX")
+            self.assertEqual(saved.call_count, 2)
+
+# Runs the tasks given to the backfill worker at once, in the calling thread
+class InlineExecutor:
+    def submit(self, func, *args):
+        func(*args)
+
+
+@override_settings(ALLOWED_HOSTS=["testserver"], REVIEWS_SOURCE="database")
+class StoredReviewsTests(TestCase):
+    def setUp(self):
+        caches["default"].clear()
+        get_sentiment_cache().clear()
+
+    def test_dealer_page_reads_and_stores_sentiments(self):
+        for text in ("Great car", "Terrible service", "Great car"):
+            Review.objects.create(dealership=15, name="Ada Lee", purchase=False, review=text)
+        backend = mock.Mock()
+        backend.analyze_batch.side_effect = lambda texts: [
+            "positive" if "Great" in text else None for text in texts]
+        with mock.patch("djangoapp.views.get_dealer_by_id", return_value=None), \
+                mock.patch("djangoapp.restapis.get_backfill_executor", return_value=InlineExecutor()), \
+                mock.patch("djangoapp.restapis.get_sentiment_backend", return_value=backend), \
+                self.assertLogs("djangoapp.restapis", "WARNING"):
+            response = self.client.get("/djangoapp/dealer/15/")
+        self.assertContains(response, "Terrible service")
+        # The failed analysis is not stored, the next page view tries again
+        self.assertEqual(dict(Review.objects.values_list("review", "sentiment").distinct()),
+                         {"Great car": "positive", "Terrible service": None})
+
+
+    def test_exact_limit_last_page_has_no_bookmark(self):
+        ids = [Review.objects.create(dealership=15, name="Ada Lee", purchase=False, review=text,
+                                     sentiment="neutral").id for text in ("One", "Two", "Three")]
+        with mock.patch("djangoapp.views.get_dealer_by_id", return_value=None), \
+                mock.patch("djangoapp.restapis.index_reviews"):
+            with override_settings(REVIEWS_PAGE_SIZE=3):
+                response = self.client.get("/djangoapp/dealer/15/")
+            self.assertEqual((len(response.context["reviews"]), response.context["next_bookmark"]), (3, None))
+            self.assertNotContains(response, "More reviews")
+            with override_settings(REVIEWS_PAGE_SIZE=2):
+                response = self.client.get("/djangoapp/dealer/15/")
+                self.assertEqual(response.context["next_bookmark"], str(ids[1]))
+                response = self.client.get("/djangoapp/dealer/15/", {"bookmark": ids[1]})
+            self.assertEqual([review.review for review in response.context["reviews"]], ["Three"])
+            self.assertIsNone(response.context["next_bookmark"])
+            # A bookmark past the last review (e.g. from an upstream that can't tell) is not an empty dealer
+            self.assertContains(self.client.get("/djangoapp/dealer/15/", {"bookmark": ids[2]}),
+                                "There are no more reviews")
+            self.assertContains(self.client.get("/djangoapp/dealer/16/"), "There are no reviews")
+
+class ReviewsPageTests(TestCase):
+    def test_page_keeps_every_doc_before_the_upstream_bookmark(self):
+        docs = [{"_id": "r{}".format(i), "dealership": 15, "name": "Ada Lee", "purchase": False,
+                 "review": "Review {}".format(i), "sentiment": "neutral"} for i in range(1, 51)]
+        json_result = {"body": {"data": {"docs": docs, "bookmark": "after-50"}}}
+        with mock.patch("djangoapp.restapis.index_reviews"):
+            # An upstream ignoring the limit: the next page starts after all 50 docs
+            reviews, bookmark = restapis.parse_dealer_reviews_page(json_result, limit=20)
+            self.assertEqual((len(reviews), reviews[-1].id, bookmark), (50, "r50", "after-50"))
+            reviews, bookmark = restapis.parse_dealer_reviews_page(
+                {"body": {"data": {"docs": docs[:20], "bookmark": "after-20"}}}, limit=20)
+            self.assertEqual((len(reviews), bookmark), (20, "after-20"))
+            reviews, bookmark = restapis.parse_dealer_reviews_page(
+                {"body": {"data": {"docs": docs[:5], "bookmark": "after-5"}}}, limit=20)
+            self.assertEqual((len(reviews), bookmark), (5, None))
+
+
+# A fake of the IAM token service (/identity/token) and of Watson NLU (/v1/analyze) that counts
+# the token exchanges and analyses
+class FakeNLUHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.startswith("/identity/token"):
+            self.server.tokens += 1
+            now = int(time.time())
+            token = jwt.encode({"iat": now, "exp": now + 3600}, "fake-iam-signing-key-of-32-bytes", algorithm="HS256")
+            body = {"access_token": token, "refresh_token": "refresh", "token_type": "Bearer",
+                    "expires_in": 3600, "expiration": now + 3600}
+        elif self.path.startswith("/v1/analyze"):
+            self.server.analyses += 1
+            self.server.authorizations.add(self.headers.get("Authorization"))
+            body = {"sentiment": {"document": {"label": "positive", "score": 0.9}}}
+        else:
+            body = {}
+        body = json.dumps(body).encode()
+        self.send_response(200 if body != b"{}" else 404)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class SentimentServiceTests(SimpleTestCase):
+    def setUp(self):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), FakeNLUHandler)
+        server.tokens = server.analyses = 0
+        server.authorizations = set()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.server = server
+
+    def test_one_token_exchange_for_many_analyses(self):
+        base = "http://127.0.0.1:{}".format(self.server.server_port)
+        # A fresh process-wide service, configured like in production from the NLU_* settings
+        with override_settings(NLU_API_KEY="key", NLU_URL=base, NLU_IAM_URL=base, NLU_TIMEOUT=5), \
+                mock.patch("djangoapp.sentiment._service", None):
+            service = get_sentiment_service()
+        for text in ("Great car", "Friendly staff", "Fast service"):
+            self.assertEqual(service.analyze(text)["sentiment"]["document"]["label"], "positive")
+        self.assertEqual((self.server.tokens, self.server.analyses), (1, 3))
+        self.assertEqual(len(self.server.authorizations), 1)
+
+
+class SentimentCacheTests(SimpleTestCase):
+    def setUp(self):
+        caches["default"].clear()
+        self.now = 1000.0
+        patcher = mock.patch("djangoapp.sentiment.time.monotonic", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = SentimentCache(max_size=2, ttl=60)
+        cache.set("a", "positive")
+        cache.set("b", "negative")
+        self.assertEqual(cache.get("a"), "positive")
+        cache.set("c", "neutral")
+        # "b" was used least recently
+        self.assertEqual([cache.get(text) for text in "abc"], ["positive", None, "neutral"])
+        self.assertEqual(cache.stats(), {"hits": 3, "misses": 1, "size": 2})
+
+    def test_entries_expire(self):
+        cache = SentimentCache(ttl=60)
+        cache.set("a", "positive")
+        self.now += 59
+        self.assertEqual(cache.get("a"), "positive")
+        self.now += 1
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1, "size": 0})
+        cache.clear()
+        self.assertEqual(cache.stats(), {"hits": 0, "misses": 0, "size": 0})
+
+    def test_shared_backend_is_read_through(self):
+        worker, other_worker = SentimentCache(ttl=60, backend="default"), SentimentCache(ttl=60, backend="default")
+        worker.set("a", "positive")
+        self.assertEqual(other_worker.stats()["size"], 0)
+        # A label analyzed by another worker is a hit, kept in process memory from then on
+        self.assertEqual(other_worker.get("a"), "positive")
+        self.assertEqual(other_worker.stats(), {"hits": 1, "misses": 0, "size": 1})
+        caches["default"].clear()
+        self.assertEqual(other_worker.get("a"), "positive")
+        self.assertIsNone(other_worker.get("b"))
+
+
+@override_settings(ALLOWED_HOSTS=["testserver"])
+class SentimentCacheViewTests(DataServiceMixin, TestCase):
+    def test_warm_dealer_page_analyzes_nothing(self):
+        get_sentiment_cache().clear()
+        backend = mock.Mock()
+        backend.analyze_batch.side_effect = lambda texts: ["positive"] * len(texts)
+        with override_settings(DEALERSHIPS_URL=self.base + "/dealership", DEALER_URL=self.base + "/dealer",
+                               REVIEWS_URL=self.base + "/review"), \
+                mock.patch("djangoapp.restapis.get_backfill_executor", return_value=InlineExecutor()), \
+                mock.patch("djangoapp.restapis.get_sentiment_backend", return_value=backend):
+            # The first render shows neutral labels and has the reviews analyzed in the background
+            self.assertNotContains(self.client.get("/djangoapp/dealer/15/"), "emoji/positive.png")
+            self.assertEqual(backend.analyze_batch.call_count, 1)
+            backend.analyze_batch.reset_mock()
+            self.assertContains(self.client.get("/djangoapp/dealer/15/"), "emoji/positive.png")
+        self.assertEqual(backend.analyze_batch.call_count, 0)
+
+
+class LocalSentimentTests(SimpleTestCase):
+    def setUp(self):
+        self.local = LocalSentimentBackend()
+
+    def test_labels(self):
+        self.assertEqual(self.local.analyze_batch(["Great car, friendly staff", "Terrible service",
+                                                   "The car is blue", "not good"]),
+                         ["positive", "negative", "neutral", "negative"])
+
+    def test_negator_stays_in_its_text(self):
+        # "not" ends the first text, it must not flip "great" at the start of the second
+        texts = ["I would not", "great service"]
+        self.assertEqual(self.local.analyze_batch(texts), ["neutral", "positive"])
+        self.assertEqual(self.local.score_batch(texts).tolist(),
+                         [self.local.score_batch([text])[0] for text in texts])
+
+    def test_empty_texts(self):
+        self.assertEqual(self.local.analyze_batch([]), [])
+        self.assertEqual(self.local.analyze_batch(["", ""]), ["neutral", "neutral"])
+        self.assertEqual(self.local.analyze_batch(["", "excellent", ""]), ["neutral", "positive", "neutral"])
+
+    def test_local_first_asks_the_remote_about_unsure_texts(self):
+        remote = mock.Mock()
+        remote.analyze_batch.return_value = ["positive", None]
+        backend = LocalFirstSentimentBackend(self.local, remote)
+        self.assertEqual(backend.analyze_batch(["Terrible service", "The car is blue", "It was fine I guess"]),
+                         ["negative", "positive", "neutral"])
+        remote.analyze_batch.assert_called_once_with(["The car is blue", "It was fine I guess"])
+        # Without an answer from the remote backend the local label stays
+        remote.analyze_batch.return_value = [None, None]
+        self.assertEqual(backend.analyze_batch(["The car is blue", "not good"]), ["neutral", "negative"])
+        self.assertEqual(backend.analyze_batch([]), [])
+
+
+class StreamingDecoderTests(SimpleTestCase):
+    records = [{"id": 1, "name": "Citroën Dealer", "city": "Zürich"}, {"id": 2, "name": "日本の車", "tags": ["[", "]"]},
+               {"id": 3, "name": "quote \\\" and bracket [", "nested": {"a": [1, 2, {"b": None}]}}]
+
+    def test_array_is_read_across_chunk_boundaries(self):
+        data = json.dumps({"note": "a [key", "dealerships": self.records}, ensure_ascii=False).encode()
+        for chunk_size in (1, 2, 3, 7, 1 << 20):
+            records = [record for record, _ in iter_json_array(io.BytesIO(data), chunk_size=chunk_size)]
+            self.assertEqual(records, self.records)
+        numbers = [record for record, _ in iter_json_array(io.BytesIO(b"[1, 234, -5.5e3 ,67]"), chunk_size=1)]
+        self.assertEqual(numbers, [1, 234, -5500.0, 67])
+
+    def test_array_resumes_from_a_yielded_offset(self):
+        data = json.dumps({"dealerships": self.records}, ensure_ascii=False).encode()
+        offsets = [offset for _, offset in iter_json_array(io.BytesIO(data), chunk_size=3)]
+        for index, offset in enumerate(offsets):
+            rest = [record for record, _ in iter_json_array(io.BytesIO(data), start=offset, chunk_size=3)]
+            self.assertEqual(rest, self.records[index + 1:])
+
+    def test_lines_resume_from_a_yielded_offset(self):
+        data = "".join(json.dumps(record, ensure_ascii=False) + "\n\n" for record in self.records).encode()
+        offsets = [offset for _, offset in iter_json_lines(io.BytesIO(data))]
+        self.assertEqual(offsets[-1], len(data) - 1)
+        rest = [record for record, _ in iter_json_lines(io.BytesIO(data), start=offsets[0])]
+        self.assertEqual(rest, self.records[1:])
+
+
+class ReviewSearchIndexTests(SimpleTestCase):
+    def setUp(self):
+        rng = random.Random(7)
+        words = ["great", "car", "friendly", "staff", "slow", "service"]
+        self.reviews = []
+        for i in range(300):
+            review = DealerReview(rng.randint(1, 5), i, "Reviewer {}".format(i), rng.random() < 0.5,
+                                  " ".join(rng.sample(words, 3)).capitalize(), rng.choice(["Audi", "Ford", None]),
+                                  rng.choice(["A6", "Focus"]), rng.choice([2010, 2015]), None,
+                                  rng.choice(["positive", "neutral", "negative"]))
+            self.reviews.append((review, rng.choice(["TX", "CA"])))
+        self.index = ReviewSearchIndex()
+        self.index.add(self.reviews)
+
+    # The reviews a search should find, newest first, by brute force
+    def expected(self, text, dealership, **filters):
+        fields = {"make": "car_make", "sentiment": "sentiment", "year": "car_year"}
+        found = []
+        for review, state in reversed(self.reviews):
+            words = set(review.review.casefold().split())
+            if text and not set(text.casefold().split()) <= words:
+                continue
+            if dealership is not None and review.dealership != dealership:
+                continue
+            if filters.get("state") is not None and state.casefold() != filters["state"].casefold():
+                continue
+            if any(filters.get(name) is not None and str(getattr(review, field)).casefold() != str(filters[name]).casefold()
+                   for name, field in fields.items()):
+                continue
+            found.append(review)
+        return found
+
+    def test_search_matches_a_scan_of_every_review(self):
+        for text, dealership, make, sentiment, state, year in itertools.product(
+                [None, "great", "Great CAR", "unknown"], [None, 3], [None, "audi", "Tesla"],
+                [None, "negative"], [None, "TX"], [None, 2015]):
+            filters = {"make": make, "sentiment": sentiment, "state": state, "year": year}
+            expected = self.expected(text, dealership, **filters)
+            result = self.index.search(text, limit=10, offset=5, dealership=dealership, **filters)
+            self.assertEqual(result["total"], len(expected))
+            self.assertEqual([review["name"] for review in result["reviews"]],
+                             [review.name for review in expected[5:15]])
+            makes = {}
+            for review in expected:
+                makes[review.car_make] = makes.get(review.car_make, 0) + 1
+            self.assertEqual(result["facets"]["make"], makes)
+
+    def test_updated_reviews_move_between_facets(self):
+        review, state = self.reviews[0]
+        before = self.index.search(sentiment="positive")["total"]
+        sentiment = review.sentiment
+        review.sentiment = "positive"
+        self.index.add([(review, state)])
+        self.assertEqual(len(self.index), 300)
+        self.assertEqual(self.index.search(sentiment="positive")["total"], before + (sentiment != "positive"))
+
+
+class CachedCatalogTests(SimpleTestCase):
+    def setUp(self):
+        # The loader returns the number of its call, the calls listed in `blocked` wait for `gate`
+        self.calls = []
+        self.blocked = set()
+        self.failing = set()
+        self.gate = threading.Event()
+        self.catalog = CachedCatalog(self.load, ttl=0)
+        self.addCleanup(self.gate.set)
+
+    def load(self, previous):
+        self.calls.append(previous)
+        call = len(self.calls)
+        if call in self.blocked:
+            self.gate.wait(5)
+        if call in self.failing:
+            raise ValueError("upstream down")
+        return call
+
+    def wait_for_refresh(self):
+        deadline = time.monotonic() + 5
+        while self.catalog._refreshing:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.001)
+
+    def test_expired_value_is_reloaded_once(self):
+        self.assertEqual(self.catalog.get(), 1)
+        self.blocked.add(2)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            values = list(executor.map(lambda _: self.catalog.get(), range(32)))
+        # The stale value is served while the single reload waits
+        self.assertEqual(values, [1] * 32)
+        self.assertEqual(self.calls, [None, 1])
+        self.gate.set()
+        self.wait_for_refresh()
+        self.assertEqual(self.catalog._value, 2)
+        self.assertEqual(self.calls, [None, 1])
+
+    def test_failed_reload_keeps_the_stale_value(self):
+        self.catalog.get()
+        self.failing.add(2)
+        with self.assertLogs("djangoapp.catalog", "ERROR"):
+            self.assertEqual(self.catalog.get(), 1)
+            self.wait_for_refresh()
+        self.assertEqual(self.catalog.get(), 1)
+        # The next get() after the failure tries again
+        self.wait_for_refresh()
+        self.assertEqual((self.catalog._value, self.calls), (3, [None, 1, 1]))
+
+    def test_invalidate_during_a_reload_wins(self):
+        self.catalog.get()
+        self.blocked.add(2)
+        self.assertEqual(self.catalog.get(), 1)
+        self.catalog.invalidate()
+        # The next get() loads at once, from scratch
+        self.assertEqual(self.catalog.get(), 3)
+        self.gate.set()
+        self.wait_for_refresh()
+        # The reload that started before invalidate() doesn't bring its value back
+        self.assertEqual(self.catalog._value, 3)
+        self.assertEqual(self.calls, [None, 1, None])
+
+
+class DealerIndexTests(SimpleTestCase):
+    @staticmethod
+    def dealer(dealer_id, st="TX", zip="73301", city="Austin"):
+        return CarDealer("{} Main Street".format(dealer_id), city, "Dealer {}".format(dealer_id), dealer_id,
+                         30.0, -97.0, "D{}".format(dealer_id), st, zip)
+
+    @staticmethod
+    def ids(index):
+        return ([dealer.id for dealer in index.dealers], sorted(index.by_id),
+                {key: [dealer.id for dealer in group] for key, group in index.by_state.items()},
+                {key: [dealer.id for dealer in group] for key, group in index.by_zip.items()})
+
+    def test_incremental_build_matches_a_full_build(self):
+        states = ["TX", "CA", "NY"]
+        old = [self.dealer(i, states[i % 3], str(70000 + i % 7)) for i in range(1, 31)]
+        previous = DealerIndex.build(old)
+        # Dealer 2 moves to another state, 3 changes city, 4 and 5 are removed and 31 is new
+        new = [self.dealer(i, states[i % 3], str(70000 + i % 7)) for i in range(1, 32) if i not in (4, 5)]
+        new[1] = self.dealer(2, "WA", "98101")
+        new[2].city = "Dallas"
+        index = DealerIndex.build(new, previous)
+        self.assertEqual(self.ids(index), self.ids(DealerIndex.build(new)))
+        self.assertEqual(index.by_id[3].city, "Dallas")
+        # Unchanged dealers keep their objects, the buckets without changes are reused as they are
+        self.assertIs(index.by_id[1], old[0])
+        self.assertIs(index.by_zip["70006"], previous.by_zip["70006"])
+        self.assertNotIn("70006", {dealer.zip for dealer in (old[1], old[3], old[4], new[1], new[2], new[-1])})
+        self.assertIs(DealerIndex.build([self.dealer(i, states[i % 3], str(70000 + i % 7)) for i in range(1, 31)],
+                                        previous), previous)
+
+
+    def test_pages_of_unknown_states_are_empty_and_not_cached(self):
+        index = DealerIndex.build([self.dealer(i, ["TX", "CA"][i % 2]) for i in range(1, 11)])
+        self.assertEqual([dealer.id for dealer in index.page(state="TX", sort="id", limit=3)[1]], [2, 4, 6])
+        for state in ("ZZ", "tx", "x" * 1000):
+            self.assertEqual(index.page(state=state), (0, []))
+        self.assertEqual(set(index._sorted), {("TX", "id")})
+
+class GeoIndexTests(SimpleTestCase):
+    def setUp(self):
+        rng = random.Random(10)
+        # Spread over the globe, plus clusters around the date line and both poles
+        self.points = ([(rng.uniform(-90, 90), rng.uniform(-180, 180)) for _ in range(300)] +
+                       [(rng.uniform(-10, 10), rng.choice([-1, 1]) * rng.uniform(178, 180)) for _ in range(50)] +
+                       [(rng.choice([-1, 1]) * rng.uniform(88, 90), rng.uniform(-180, 180)) for _ in range(50)])
+        self.index = GeoIndex(range(len(self.points)), *zip(*self.points))
+        self.queries = [(0.0, 179.9), (5.0, -179.9), (89.9, 0.0), (-89.5, 120.0), (31.7, -106.3)] + \
+                       [(rng.uniform(-90, 90), rng.uniform(-180, 180)) for _ in range(20)]
+
+    def scan(self, lat, long):
+        distances = haversine_km(lat, long, *np.array(self.points).T)
+        return [(int(i), float(distances[i])) for i in np.argsort(distances)]
+
+    def assertMatches(self, found, expected):
+        self.assertEqual([item for item, _ in found], [item for item, _ in expected])
+        for (_, distance), (_, expected_distance) in zip(found, expected):
+            self.assertAlmostEqual(distance, expected_distance, delta=1e-3)
+
+    def test_nearest_matches_a_scan(self):
+        for lat, long in self.queries:
+            for k in (1, 5, 40):
+                self.assertMatches(self.index.nearest(lat, long, k), self.scan(lat, long)[:k])
+        # Asking for more items than there are returns them all
+        self.assertMatches(self.index.nearest(10, 20, k=1000), self.scan(10, 20))
+
+    def test_within_matches_a_scan(self):
+        for lat, long in self.queries:
+            for radius in (0, 300, 2500, 30000):
+                self.assertMatches(self.index.within(lat, long, radius),
+                                   [(item, distance) for item, distance in self.scan(lat, long) if distance <= radius])
+
+    def test_neighbours_across_the_date_line_and_the_poles(self):
+        index = GeoIndex(["east", "west", "far", "north"], [0, 0, 0, 89.9], [179.9, -179.9, 170, 180])
+        self.assertEqual([item for item, _ in index.nearest(0, 179.95, 2)], ["east", "west"])
+        self.assertEqual([item for item, _ in index.within(0, -179.95, 50)], ["west", "east"])
+        self.assertEqual([item for item, _ in index.nearest(89.9, -90, 1)], ["north"])
+
+    def test_empty_index(self):
+        index = GeoIndex([], [], [])
+        self.assertEqual(index.nearest(0, 0, 5), [])
+        self.assertEqual(index.within(0, 0, 1000), [])
+
+
+@override_settings(ALLOWED_HOSTS=["testserver"])
+class NearbyDealersViewTests(DataServiceMixin, TestCase):
+    def get(self, query):
+        with override_settings(DEALERSHIPS_URL=self.base + "/dealership"):
+            return self.client.get("/djangoapp/dealers/near/" + query)
+
+    def test_bad_parameters(self):
+        for query in ("", "?lat=31.7", "?lat=north&long=-106.3", "?lat=31.7&long=-106.3&k=two",
+                      "?lat=91&long=0", "?lat=0&long=181", "?lat=0&long=0&k=0", "?lat=0&long=0&k=101",
+                      "?lat=0&long=0&radius=-1"):
+            self.assertEqual(self.get(query).status_code, 400, query)
+
+    def test_dealers_nearest_first(self):
+        dealers = [json.loads(doc) for _, doc in self.store.all_dealers()]
+        distances = {dealer["id"]: float(haversine_km(31.7, -106.3, dealer["lat"], dealer["long"]))
+                     for dealer in dealers}
+        expected = sorted(round(distance, 3) for distance in distances.values())
+        # Dealers 1 and 16 share a location, so compare distances rather than the order of ties
+        found = self.get("?lat=31.7&long=-106.3&k=5").json()["dealers"]
+        self.assertEqual([dealer["distance_km"] for dealer in found], expected[:5])
+        self.assertTrue(all(dealer["distance_km"] == round(distances[dealer["id"]], 3) for dealer in found))
+        found = self.get("?lat=31.7&long=-106.3&radius=500").json()["dealers"]
+        self.assertEqual([dealer["distance_km"] for dealer in found],
+                         [distance for distance in expected if distance <= 500])
+        self.assertTrue(all(dealer["distance_km"] == round(distances[dealer["id"]], 3) for dealer in found))
+        self.assertTrue(found)
+
+
+# The dealer pages with settings.ASYNC_VIEWS on, served by the async views through the ASGI
+# request handler, against the local data service
+@override_settings(ALLOWED_HOSTS=["testserver"], REVIEWS_PAGE_SIZE=2)
+class AsyncViewsTests(DataServiceMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        make = CarMake.objects.create(name="Audi", description="German")
+        cls.car = CarModel.objects.create(car_make=make, name="A6", dealer_id=15, year=datetime.date(2010, 1, 1))
+        cls.user = User.objects.create_user("reviewer", password="password", first_name="Ada", last_name="Lee")
+
+    def setUp(self):
+        super().setUp()
+        urls = override_settings(ASYNC_VIEWS=True, DEALERSHIPS_URL=self.base + "/dealership",
+                                 DEALER_URL=self.base + "/dealer", REVIEWS_URL=self.base + "/review")
+        urls.enable()
+        self.addCleanup(self.reload_urls)
+        self.addCleanup(urls.disable)
+        self.reload_urls()
+        self.assertIs(resolve("/djangoapp/dealer/15/").func, async_views.get_dealer_details)
+        get_sentiment_cache().clear()
+        backend = mock.Mock()
+        backend.analyze_batch.side_effect = lambda texts: ["neutral"] * len(texts)
+        for patcher in (mock.patch("djangoapp.restapis.get_async_client", return_value=AsyncHttpClient({"RETRIES": 0})),
+                        mock.patch("djangoapp.restapis.get_backfill_executor", return_value=InlineExecutor()),
+                        mock.patch("djangoapp.restapis.get_sentiment_backend", return_value=backend)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    # urls.py picks the sync or async dealer views when it is imported, the project's urls
+    # hold the resolver of the included module
+    @staticmethod
+    def reload_urls():
+        importlib.reload(djangoapp_urls)
+        importlib.reload(importlib.import_module(settings.ROOT_URLCONF))
+        clear_url_caches()
+
+    async def test_dealer_details_pages_through_the_reviews(self):
+        docs = [json.loads(doc) for doc in self.store.reviews(15)[0]]
+        self.assertGreater(len(docs), 2)
+        response = await self.async_client.get("/djangoapp/dealer/15/")
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "More reviews")
+        # The pages (2 reviews each) hold every review of the dealer, in order
+        reviews = []
+        while True:
+            reviews += [review.review for review in response.context["reviews"]]
+            bookmark = response.context["next_bookmark"]
+            if bookmark is None:
+                break
+            response = await self.async_client.get("/djangoapp/dealer/15/", {"bookmark": bookmark})
+        self.assertEqual(reviews, [doc["review"] for doc in docs])
+
+    async def test_dealer_details_without_reviews_is_unavailable(self):
+        self.faults.error_rate = 1
+        with self.assertLogs("djangoapp.restapis", "WARNING"):
+            response = await self.async_client.get("/djangoapp/dealer/15/")
+        self.assertContains(response, "reviews are unavailable", status_code=503)
+
+    async def test_dealerships_json_page(self):
+        response = await self.async_client.get("/djangoapp/", {"format": "json", "state": "TX", "limit": 3})
+        self.assertEqual(response.status_code, 200)
+        expected = [json.loads(doc)["id"] for doc in self.store.dealers_by_state("TX")]
+        self.assertEqual(response.json()["total"], len(expected))
+        self.assertEqual([row["id"] for row in response.json()["rows"]], expected[:3])
+        self.assertEqual(response.json()["totalNotFiltered"], len(self.store.all_dealers()))
+
+    async def test_add_review(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get("/djangoapp/dealer/15/add-review/")
+        self.assertContains(response, "A6")
+        with mock.patch("djangoapp.views.analyze_review_sentiments", return_value="positive"), \
+                mock.patch("djangoapp.async_views.store_review") as store_review:
+            response = await self.async_client.post("/djangoapp/dealer/15/add-review/",
+                                                     {"content": "Great car", "car": self.car.id})
+            self.assertRedirects(response, "/djangoapp/dealer/15/", fetch_redirect_response=False)
+            self.assertEqual(store_review.call_args[0][0]["review"], "Great car")
+            self.assertEqual(json.loads(self.store.reviews(15)[0][-1])["review"], "Great car")
+            # A failed post is not stored and says so
+            store_review.reset_mock()
+            self.faults.error_rate = 1
+            with self.assertLogs("djangoapp", "WARNING"):
+                response = await self.async_client.post("/djangoapp/dealer/15/add-review/",
+                                                         {"content": "Great car", "car": self.car.id})
+            self.assertContains(response, "could not be posted", status_code=503)
+            self.assertFalse(store_review.called)
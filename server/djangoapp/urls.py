@@ -2,6 +2,10 @@ from django.urls import path
 from django.conf.urls.static import static
 from django.conf import settings
 from . import views
+from . import async_views
+
+# The dealer pages have async versions for ASGI servers (see async_views.py)
+dealer_views = async_views if settings.ASYNC_VIEWS else views
 
 app_name = 'djangoapp'
 urlpatterns = [
@@ -21,11 +25,17 @@ urlpatterns = [
     # path for logout
     path(route ='logout/',view =  views.logout_request, name='logout'),
 
-    path(route ='',view = views.get_dealerships, name='index'),
+    path(route ='',view = dealer_views.get_dealerships, name='index'),
+    # path for the dealers closest to a location
+    path(route='dealers/near/', view=views.get_nearby_dealers, name='dealers_near'),
+    # path for the review search
+    path(route='reviews/search/', view=views.search_reviews, name='search_reviews'),
+    # path for the timing histograms and counters (settings.INSTRUMENTATION)
+    path(route='metrics/', view=views.get_metrics, name='metrics'),
     # path for dealer reviews view
-    path(route='dealer/<int:dealer_id>/', view=views.get_dealer_details, name='dealer_details'),
+    path(route='dealer/<int:dealer_id>/', view=dealer_views.get_dealer_details, name='dealer_details'),
 
     # path for add a review view
-    path(route='dealer/<int:dealer_id>/add-review/', view=views.add_review, name="add_review")
+    path(route='dealer/<int:dealer_id>/add-review/', view=dealer_views.add_review, name="add_review")
 
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
@@ -1,9 +1,15 @@
+import requests
 from django.shortcuts import render
-from django.http import HttpResponseRedirect, HttpResponse
+from django.http import Http404, HttpResponseRedirect, HttpResponse, HttpResponseBadRequest, JsonResponse
 from django.contrib.auth.models import User
 from django.shortcuts import get_object_or_404, render, redirect
-from .models import CarModel 
-from .restapis import get_dealer_by_id, get_dealers_from_cf,get_dealers_by_state,get_dealer_reviews_from_cf,post_request
+from .breaker import CircuitOpenError, UpstreamUnavailable, breaker_states
+from .cars import get_car_choices
+from .instrumentation import enabled as instrumentation_enabled, metrics, span
+from .models import CarModel, DealerStats
+from .search import get_review_search_index
+from .restapis import get_dealer_by_id, get_dealer_index,get_dealers_near,get_dealer_reviews_page,fetch_concurrently,post_request,analyze_review_sentiments,store_review,upstream_flights
+from django.conf import settings
 from django.contrib.auth import login, logout, authenticate
 from django.contrib import messages
 from datetime import datetime
@@ -33,7 +39,7 @@ def contact(request):
 # Create a `login_request` view to handle sign in request
 def logout_request(request):
     # Get the user object based on session id in request
-    print("Log out the user `{}`".format(request.user.username))
+    logger.debug("Log out the user `{}`".format(request.user.username))
     # Logout user in the request
     logout(request)
     # Redirect user back to course list view
@@ -95,13 +101,107 @@ def registration_request(request):
 def get_dealerships(request):
     if request.method == "GET":
         context = {}
-        url = "https://9bebcb01.eu-de.apigw.appdomain.cloud/api/dealership"
-        # Get dealers from the URL
-        context["dealerships"] = get_dealers_from_cf(url)
-        # Concat all dealer's short name
-        #dealer_names = ' '.join([dealer.short_name for dealer in dealerships])
-        # Return a list of dealer short name
-        return render(request, 'djangoapp/index.html', context)
+        url = settings.DEALERSHIPS_URL
+        # Get dealers from the URL, served from the cached catalog
+        try:
+            dealer_index = get_dealer_index(url)
+        except UpstreamUnavailable:
+            return unavailable_response(request, as_json=request.GET.get("format") == "json")
+        # The dealer table loads its rows one page at a time with ?format=json
+        if request.GET.get("format") == "json":
+            return dealers_page_response(request, dealer_index)
+        # The page itself only needs the states for the state filter
+        context["states"] = sorted(dealer_index.by_state)
+        context["total"] = len(dealer_index.dealers)
+        with span("render"):
+            return render(request, 'djangoapp/index.html', context)
+
+
+# Answers a request whose upstream data is unavailable (see UpstreamUnavailable) with a 503:
+# a JSON error for the JSON endpoints, a "data unavailable" page (or `message`) otherwise
+def unavailable_response(request, as_json=False, message=None):
+    if as_json:
+        return JsonResponse({"error": "The dealership data is unavailable right now"}, status=503)
+    return render(request, 'djangoapp/unavailable.html', {"message": message}, status=503)
+
+
+NOT_POSTED = "Your review could not be posted right now, please try again in a few minutes."
+
+
+# Returns one page of the dealer index as JSON for the dealer table
+# (bootstrap-table server side pagination: offset, limit, sort, order and a `filter` on state)
+def dealers_page_response(request, dealer_index):
+    try:
+        offset = max(int(request.GET.get("offset", 0)), 0)
+        limit = min(max(int(request.GET.get("limit", 20)), 1), 100)
+        filters = json.loads(request.GET.get("filter") or "{}")
+    except ValueError:
+        return HttpResponseBadRequest("offset and limit must be numbers, filter must be JSON")
+    if not isinstance(filters, dict):
+        return HttpResponseBadRequest("filter must be a JSON object")
+    state = request.GET.get("state") or filters.get("st") or None
+    sort = request.GET.get("sort") or "id"
+    if sort not in dealer_index.SORT_FIELDS:
+        return HttpResponseBadRequest("Can't sort by {}".format(sort))
+    total, dealers = dealer_index.page(state=state, sort=sort, descending=request.GET.get("order") == "desc",
+                                       offset=offset, limit=limit)
+    # The review aggregates of the page's dealers, in one primary key lookup
+    stats = DealerStats.objects.in_bulk([dealer.id for dealer in dealers])
+    return JsonResponse({"total": total, "totalNotFiltered": len(dealer_index.dealers),
+                         "rows": [dict(dealer.to_dict(), stats=stats[dealer.id].to_dict() if dealer.id in stats
+                                       else None) for dealer in dealers]})
+
+
+# Create a `get_nearby_dealers` view to return the dealers closest to a location as JSON
+# e.g. /djangoapp/dealers/near/?lat=31.69&long=-106.3&k=5 or ?lat=31.69&long=-106.3&radius=50 (km)
+def get_nearby_dealers(request):
+    if request.method == "GET":
+        try:
+            lat = float(request.GET["lat"])
+            long = float(request.GET["long"])
+            k = int(request.GET.get("k", 5))
+            radius = float(request.GET["radius"]) if "radius" in request.GET else None
+        except (KeyError, ValueError):
+            return HttpResponseBadRequest("lat and long are required, k and radius must be numbers")
+        if not (-90 <= lat <= 90 and -180 <= long <= 180) or not (0 < k <= 100) or (radius is not None and radius < 0):
+            return HttpResponseBadRequest("lat, long, k or radius out of range")
+        try:
+            dealers = get_dealers_near(settings.DEALERSHIPS_URL, lat, long, k=k, radius_km=radius)
+        except UpstreamUnavailable:
+            return unavailable_response(request, as_json=True)
+        return JsonResponse({"dealers": [dict(dealer.to_dict(), distance_km=round(distance, 3))
+                                         for dealer, distance in dealers]})
+
+
+# Create a `search_reviews` view to search the indexed reviews and return them as JSON with facet counts
+# e.g. /djangoapp/reviews/search/?make=Audi&model=A6&sentiment=negative&state=TX or ?q=friendly+staff&year=2010
+def search_reviews(request):
+    if request.method == "GET":
+        try:
+            year = int(request.GET["year"]) if request.GET.get("year") else None
+            dealership = int(request.GET["dealer"]) if request.GET.get("dealer") else None
+            offset = max(int(request.GET.get("offset", 0)), 0)
+            limit = min(max(int(request.GET.get("limit", 20)), 1), 100)
+        except ValueError:
+            return HttpResponseBadRequest("year, dealer, offset and limit must be numbers")
+        result = get_review_search_index().search(
+            request.GET.get("q"), limit=limit, offset=offset, make=request.GET.get("make"),
+            model=request.GET.get("model"), year=year, sentiment=request.GET.get("sentiment"),
+            state=request.GET.get("state"), dealership=dealership)
+        return JsonResponse(result)
+
+
+# Create a `metrics` view to return the timing histograms and counters of this process as JSON
+# (only when settings.INSTRUMENTATION is on), with the state of the upstream circuits and of the
+# coalesced upstream calls
+def get_metrics(request):
+    if not instrumentation_enabled():
+        raise Http404("Instrumentation is off")
+    snapshot = metrics.snapshot()
+    snapshot["counters"]["upstream_calls"] = upstream_flights.calls
+    snapshot["counters"]["upstream_calls_shared"] = upstream_flights.shared
+    snapshot["circuits"] = breaker_states()
+    return JsonResponse(snapshot)
 
 
 # Create a `get_dealer_details` view to render the reviews of a dealer
@@ -110,14 +210,35 @@ def get_dealerships(request):
 def get_dealer_details(request, dealer_id):
     context = {}
     if request.method == "GET":
-        url = 'https://9bebcb01.eu-de.apigw.appdomain.cloud/api/review'
-        reviews = get_dealer_reviews_from_cf(url,dealer_id)
+        url = settings.REVIEWS_URL
+        # The reviews and the dealer are fetched at the same time
+        # Only one page of reviews is fetched, the next one starts at its bookmark
+        fetches = {
+            "reviews": lambda: get_dealer_reviews_page(url, dealer_id, limit=settings.REVIEWS_PAGE_SIZE,
+                                                       bookmark=request.GET.get("bookmark")),
+            "dealer": lambda: get_dealer_by_id(settings.DEALER_URL, dealer_id=dealer_id),
+        }
+        # Reviews read from the Review table are an ORM query, which runs in the request thread
+        if settings.REVIEWS_SOURCE == "database":
+            results, errors = fetch_concurrently(remote={"dealer": fetches.pop("dealer")}, local=fetches)
+        else:
+            results, errors = fetch_concurrently(remote=fetches)
+        # Without the reviews the page says they are unavailable
+        unavailable = isinstance(errors.get("reviews"), UpstreamUnavailable)
+        if "reviews" in errors and not unavailable:
+            raise errors["reviews"]
+        reviews, next_bookmark = results.get("reviews", ([], None))
         context = {
             "reviews":  reviews, 
-            "dealer_id": dealer_id
+            "dealer_id": dealer_id,
+            "next_bookmark": next_bookmark,
+            # The page still works without the dealer's name
+            "dealer": results.get("dealer"),
+            "unavailable": unavailable,
         }
 
-        return render(request, 'djangoapp/dealer_details.html', context)
+        with span("render"):
+            return render(request, 'djangoapp/dealer_details.html', context, status=503 if unavailable else 200)
 
 # Create a `add_review` view to submit a review
 def add_review(request, dealer_id):
@@ -125,46 +246,67 @@ def add_review(request, dealer_id):
     if request.user.is_authenticated:
         # GET request renders the page with the form for filling out a review
         if request.method == "GET":
-            url = "https://5b93346d.us-south.apigw.appdomain.cloud/dealerships/dealer-get?dealerId={dealer_id}"
-            # Get dealer details from the API
+            url = settings.DEALER_URL
+            # Get dealer details from the API while the dealer's cars are loaded from the database (or cache)
+            results, errors = fetch_concurrently(
+                remote={"dealer": lambda: get_dealer_by_id(url, dealer_id=dealer_id)},
+                local={"cars": lambda: get_car_choices(dealer_id)},
+            )
+            for error in errors.values():
+                if isinstance(error, UpstreamUnavailable):
+                    return unavailable_response(request)
+                raise error
             context = {
-                "cars": CarModel.objects.all(),
-                "dealer": get_dealer_by_id(url, dealer_id=dealer_id),
+                "cars": results["cars"],
+                "dealer": results["dealer"],
             }
-            return render(request, 'djangoapp/add_review.html', context)
+            with span("render"):
+                return render(request, 'djangoapp/add_review.html', context)
 
         # POST request posts the content in the review submission form to the Cloudant DB using the post_review Cloud Function
         if request.method == "POST":
-            form = request.POST
-            review = dict()
-            review["name"] = "{request.user.first_name} {request.user.last_name}"
-            review["dealership"] = dealer_id
-            review["review"] = form["content"]
-            review["purchase"] = form.get("purchasecheck")
-            if review["purchase"]:
-                review["purchase_date"] = datetime.strptime(form.get("purchasedate"), "%m/%d/%Y").isoformat()
-            car = CarModel.objects.get(pk=form["car"])
-            review["car_make"] = car.car_make.name
-            review["car_model"] = car.name
-            review["car_year"] = car.year
-            
-            # If the user bought the car, get the purchase date
-            if form.get("purchasecheck"):
-                review["purchase_date"] = datetime.strptime(form.get("purchasedate"), "%m/%d/%Y").isoformat()
-            else: 
-                review["purchase_date"] = None
-
-            url = "https://9bebcb01.eu-de.apigw.appdomain.cloud/api/review"  
+            review = review_from_form(request, dealer_id)
+            url = settings.REVIEWS_URL
             json_payload = {"review": review}  
-            result = post_request(url, json_payload, dealerId=dealer_id)
-            if int(result.status_code) == 200:
-                print("Review posted successfully.")
+            try:
+                result = post_request(url, json_payload, dealerId=dealer_id)
+            except (CircuitOpenError, requests.exceptions.RequestException):
+                return unavailable_response(request, message=NOT_POSTED)
+            # The user only goes back to the dealer page when the review was really posted
+            if int(result.status_code) != 200:
+                logger.warning("Posting a review of dealer %s failed with status %s", dealer_id, result.status_code)
+                return unavailable_response(request, message=NOT_POSTED)
+            logger.debug("Review posted successfully.")
+            store_review(review)
 
             # After posting the review the user is redirected back to the dealer details page
             return redirect("djangoapp:dealer_details", dealer_id=dealer_id)
 
     else:
         # If user isn't logged in, redirect to login page
-        print("User must be authenticated before posting a review. Please log in.")
+        logger.debug("User must be authenticated before posting a review. Please log in.")
         return redirect("/djangoapp/login")
 
+
+# Creates the review to post from the add_review form
+def review_from_form(request, dealer_id):
+    form = request.POST
+    review = dict()
+    review["name"] = f"{request.user.first_name} {request.user.last_name}"
+    review["dealership"] = dealer_id
+    review["review"] = form["content"]
+    # The review text never changes, so its sentiment is analyzed once here instead of on every read
+    review["sentiment"] = analyze_review_sentiments(review["review"])
+    review["purchase"] = form.get("purchasecheck")
+    # One query for the car and its make
+    car = CarModel.objects.select_related("car_make").get(pk=form["car"])
+    review["car_make"] = car.car_make.name
+    review["car_model"] = car.name
+    review["car_year"] = car.year.year if car.year else None
+
+    # If the user bought the car, get the purchase date
+    if form.get("purchasecheck"):
+        review["purchase_date"] = datetime.strptime(form.get("purchasedate"), "%m/%d/%Y").isoformat()
+    else: 
+        review["purchase_date"] = None
+    return review
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -43,6 +44,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Server-Timing header of each request, when INSTRUMENTATION is on (see djangoapp/instrumentation.py)
+    'djangoapp.instrumentation.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -84,6 +87,21 @@ DATABASES = {
     }
 }
 
+# 'default' is private to each process. 'shared' is a file cache seen by every worker (gunicorn
+# runs 3) of the host, for data that must be invalidated in all of them at once
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('SHARED_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'djangoapp-cache')),
+        # Past MAX_ENTRIES a third of the files are culled at random, the upstream fallbacks
+        # (one per distinct GET) and car lists must fit well below it
+        'OPTIONS': {'MAX_ENTRIES': int(os.environ.get('SHARED_CACHE_MAX_ENTRIES', 20000))},
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -125,3 +143,98 @@ STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 MEDIA_ROOT = os.path.join(STATIC_ROOT, 'media')
 MEDIA_URL = '/media/'
+
+# Upstream HTTP client used by djangoapp.restapis (see djangoapp/httpclient.py)
+RESTAPI_CLIENT = {
+    'POOL_SIZE': int(os.environ.get('RESTAPI_POOL_SIZE', 10)),
+    # Per-host pool size overrides, keyed by hostname
+    'POOL_SIZES': {},
+    'CONNECT_TIMEOUT': float(os.environ.get('RESTAPI_CONNECT_TIMEOUT', 3.05)),
+    'READ_TIMEOUT': float(os.environ.get('RESTAPI_READ_TIMEOUT', 10)),
+    'RETRIES': int(os.environ.get('RESTAPI_RETRIES', 2)),
+    'BACKOFF_FACTOR': 0.3,
+}
+
+# Sentiment label cache in front of Watson NLU (see djangoapp/sentiment.py)
+# Set BACKEND to a CACHES alias to share labels between gunicorn workers
+SENTIMENT_CACHE = {
+    'MAX_SIZE': 4096,
+    'TTL': 60 * 60 * 24,
+    'BACKEND': os.environ.get('SENTIMENT_CACHE_BACKEND') or None,
+}
+
+# Watson Natural Language Understanding, used for review sentiment
+NLU_API_KEY = os.environ.get('NLU_API_KEY', '')
+NLU_URL = os.environ.get('NLU_URL', 'https://api.us-south.natural-language-understanding.watson.cloud.ibm.com/instances/9ff52216-d0c0-4586-aece-8b34ea1016d6')
+NLU_VERSION = os.environ.get('NLU_VERSION', '2021-08-01')
+# IAM token endpoint, only needs to be set to point at a non-default (e.g. local fake) IAM server
+NLU_IAM_URL = os.environ.get('NLU_IAM_URL') or None
+# Seconds (connect, read) a single analysis may take before the review falls back to 'neutral'
+NLU_TIMEOUT = (3.05, float(os.environ.get('NLU_READ_TIMEOUT', 5)))
+# Maximum number of concurrent NLU requests per process
+SENTIMENT_MAX_WORKERS = int(os.environ.get('SENTIMENT_MAX_WORKERS', 8))
+# Where review sentiment comes from: 'remote' (Watson NLU), 'local' (offline lexicon engine)
+# or 'local-first' (local engine, NLU only for texts it scores below SENTIMENT_LOCAL_MIN_CONFIDENCE)
+SENTIMENT_BACKEND = os.environ.get('SENTIMENT_BACKEND', 'remote')
+SENTIMENT_LOCAL_MIN_CONFIDENCE = 0.3
+
+# Seconds the dealer list is served from memory before it is refreshed in the background
+DEALER_CATALOG_TTL = int(os.environ.get('DEALER_CATALOG_TTL', 300))
+
+# Cloud function (API gateway) endpoints of the dealership and review data
+DEALERSHIPS_URL = os.environ.get('DEALERSHIPS_URL', 'https://9bebcb01.eu-de.apigw.appdomain.cloud/api/dealership')
+REVIEWS_URL = os.environ.get('REVIEWS_URL', 'https://9bebcb01.eu-de.apigw.appdomain.cloud/api/review')
+# Reviews shown (and analyzed) per dealer page
+REVIEWS_PAGE_SIZE = int(os.environ.get('REVIEWS_PAGE_SIZE', 20))
+DEALER_URL = os.environ.get('DEALER_URL', 'https://5b93346d.us-south.apigw.appdomain.cloud/dealerships/dealer-get')
+
+# Use the async dealer views (djangoapp/async_views.py), set by asgi.py when running under an
+# ASGI server, e.g. uvicorn djangobackend.asgi:application
+ASYNC_VIEWS = os.environ.get('ASYNC_VIEWS') == '1'
+# Threads running the independent upstream fetches of a page at the same time
+FETCH_MAX_WORKERS = int(os.environ.get('FETCH_MAX_WORKERS', 16))
+
+# Decoder of upstream JSON responses: 'auto' (orjson when installed), 'orjson' or 'json'
+JSON_DECODER = os.environ.get('JSON_DECODER', 'auto')
+
+# SQLite database of the local data service (manage.py dataservice) and of bulkdata imports,
+# kept out of the source tree: it is rebuilt from cloudant/data or an import at any time
+DATASERVICE_DB = os.environ.get('DATASERVICE_DB', os.path.join(tempfile.gettempdir(), 'djangoapp-dataservice.sqlite3'))
+
+# Where dealer pages read reviews from: 'remote' (the get-review cloud function) or 'database'
+# (the Review table, filled with manage.py bulkdata import reviews <file> --into database)
+REVIEWS_SOURCE = os.environ.get('REVIEWS_SOURCE', 'remote')
+
+# Cars offered per dealer on the add_review page, cached until a car or make is saved in the admin.
+# The cache must be shared by every worker (see CACHES), or the others serve stale cars until the TTL
+CAR_CHOICES_CACHE = {
+    'BACKEND': os.environ.get('CAR_CHOICES_CACHE_BACKEND', 'shared'),
+    'TTL': 60 * 60,
+}
+
+# Circuit breaker of each upstream endpoint: FAILURE_THRESHOLD consecutive failures make its calls
+# fail fast for RESET_TIMEOUT seconds, meanwhile GETs are answered from the last known good
+# responses kept in the FALLBACK_CACHE alias (see djangoapp/breaker.py)
+UPSTREAM_BREAKER = {
+    'FAILURE_THRESHOLD': int(os.environ.get('UPSTREAM_FAILURE_THRESHOLD', 5)),
+    'RESET_TIMEOUT': int(os.environ.get('UPSTREAM_RESET_TIMEOUT', 30)),
+    # Shared by the workers and kept across restarts, so a cold worker can serve an outage too
+    'FALLBACK_CACHE': os.environ.get('UPSTREAM_FALLBACK_CACHE', 'shared'),
+}
+
+# Timing spans of upstream calls, JSON decoding, sentiment analysis, ORM queries and template
+# rendering, with counters of cache hits and retries: added to each response as a Server-Timing
+# header and served as histograms by /djangoapp/metrics/ (see djangoapp/instrumentation.py)
+INSTRUMENTATION = os.environ.get('INSTRUMENTATION') == '1'
+
+# Log messages of the app (upstream calls, failures, fallbacks) go to the console
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'djangoapp': {'handlers': ['console'], 'level': os.environ.get('DJANGOAPP_LOG_LEVEL', 'INFO')},
+    },
+}
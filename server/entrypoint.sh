@@ -10,8 +10,7 @@
         echo "PostgreSQL started"
     fi
 
-    # Make migrations and migrate the database.
-    echo "Making migrations and migrating the database. "
-    python manage.py makemigrations main --noinput 
+    # Migrate the database, the migrations are shipped with the apps
+    echo "Migrating the database. "
     python manage.py migrate --noinput 
     exec "$@"